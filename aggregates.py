@@ -0,0 +1,186 @@
+import numpy as np
+import polars as pl
+
+# Server side aggregation for the charts of app.py:
+# every chart gets only the grouped table it draws instead of the whole dataset,
+# so the browser receives a few hundred rows per chart.
+#
+# usage (payload report): uv run python aggregates.py
+
+
+def count_by(data, *by) -> pl.DataFrame:
+    #Number of bookings for every combination of the columns in by.
+    return data.group_by(by).agg(pl.len().alias("count")).sort(by)
+
+def median_by(data, col, *by) -> pl.DataFrame:
+    return data.group_by(by).agg(pl.col(col).median()).sort(by)
+
+def bucket(col, top = 1):
+    #Values above top grouped in the label "top+" (e.g. "2+").
+    return pl.when(pl.col(col) > top).then(pl.lit(f"{top + 1}+")).otherwise(pl.col(col).cast(pl.String)).alias(col)
+
+def box_stats(data, col, by) -> pl.DataFrame:
+    #Statistics drawn by a boxplot (quartiles and 1.5 IQR whiskers, like mark_boxplot)
+    #plus the distinct values outside the whiskers, in one long table.
+    stats = data.group_by(by).agg(
+        pl.col(col).quantile(0.25).alias("q1"),
+        pl.col(col).median().alias("median"),
+        pl.col(col).quantile(0.75).alias("q3"),
+    )
+    iqr = pl.col("q3") - pl.col("q1")
+    values = data.select(by, col).join(stats, on=by)
+    inside = (pl.col(col) >= pl.col("q1") - 1.5 * iqr) & (pl.col(col) <= pl.col("q3") + 1.5 * iqr)
+    whiskers = values.filter(inside).group_by(by).agg(
+        pl.col(col).min().alias("lower"), pl.col(col).max().alias("upper"))
+    outliers = values.filter(~inside).select(by, pl.col(col).alias("outlier")).unique().sort(by, "outlier")
+    return pl.concat([stats.join(whiskers, on=by).sort(by), outliers], how="diagonal_relaxed")
+
+# rows of the loess weight matrix computed at a time: the memory is block x n, not n x n
+LOESS_BLOCK = 512
+
+def loess(x, y, bandwidth = 0.3, iterations = 2, block = LOESS_BLOCK) -> np.ndarray:
+    #Local linear regression with tricube weights over the nearest bandwidth*n points,
+    #with bisquare robustness iterations (same definition of Vega's transform_loess).
+    #Vectorized: the local fits of block points at a time are solved on their rows of the weight matrix.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    k = min(n, max(2, int(bandwidth * n)))
+    blocks = [slice(start, start + block) for start in range(0, n, block)]
+
+    def distances(rows):
+        return np.abs(x[rows, None] - x[None, :])
+
+    # distance of the k-th nearest point, the radius of every local fit
+    radius = np.empty(n)
+    for rows in blocks:
+        radius[rows] = np.partition(distances(rows), k - 1, axis=1)[:, k - 1]
+    radius[radius == 0] = 1
+    robust = np.ones(n)
+    fit = np.empty(n)
+    for _ in range(iterations):
+        for rows in blocks:
+            w = np.clip(1 - (distances(rows) / radius[rows, None]) ** 3, 0, None) ** 3 * robust
+            sw = w.sum(axis=1)
+            mx = w @ x / sw
+            my = w @ y / sw
+            var = w @ (x * x) / sw - mx ** 2
+            cov = w @ (x * y) / sw - mx * my
+            slope = np.divide(cov, var, out=np.zeros(len(sw)), where=var > 1e-12)
+            fit[rows] = my + slope * (x[rows] - mx)
+        residuals = np.abs(y - fit)
+        scale = np.median(residuals)
+        if scale < 1e-12:
+            break
+        robust = np.clip(1 - (residuals / (6 * scale)) ** 2, 0, None) ** 2
+    return fit
+
+def smooth(table, x, y, by, bandwidth) -> pl.DataFrame:
+    #Loess curve of y on x (a Date column) for every group of by.
+    curves = []
+    for _, group in table.sort(x).group_by(by, maintain_order=True):
+        days = group[x].cast(pl.Int32).to_numpy()
+        curves.append(group.select(x, by).with_columns(
+            pl.Series(y, loess(days, group[y].to_numpy(), bandwidth))))
+    return pl.concat(curves)
+
+# adr bins of the bubble chart (quantiles 0.2, 0.4, 0.6, 0.8 of adr on the dataset)
+ADR_BREAKS = [65, 85.5, 105.8, 135]
+ADR_LABELS = ["(0, 65]", "(65, 85.5]", "(85.5, 105.8]", "(105.8, 135]", "(135, 510]"]
+
+# Dimensions of the aggregate cube: every section of the EDA page is a sum of counts over some of them
+CUBE_DIMENSIONS = {
+    "hotel": pl.col("hotel"),
+    "is_canceled": pl.col("is_canceled"),
+    "month": pl.col("arrival_date").dt.truncate("1mo"),
+    "country": pl.col("country"),
+    "deposit_type": pl.col("deposit_type"),
+    "booking_changes": bucket("booking_changes"),
+    "total_of_special_requests": bucket("total_of_special_requests"),
+    "is_repeated_guest": pl.col("is_repeated_guest"),
+    "previous_cancellations": pl.col("previous_cancellations") > 0,
+    "previous_bookings_not_canceled": pl.col("previous_bookings_not_canceled") > 0,
+    "adr_bin": pl.col("adr").cut(ADR_BREAKS, labels=ADR_LABELS),
+}
+
+def build_cube(data) -> pl.DataFrame:
+    #Materialized cube: number of bookings for every combination of CUBE_DIMENSIONS.
+    return data.group_by(**CUBE_DIMENSIONS).agg(pl.len().alias("count"))
+
+def build_series(data) -> dict:
+    #Tables that are not sums over the cube (medians, boxplot, daily and lead_time series),
+    #computed once together with the cube.
+    return {
+        "shape": data.shape,
+        "summary": data.drop("index").describe(),
+        "adr_box": box_stats(data, "adr", "hotel"),
+        "adr_daily": median_by(data, "adr", "arrival_date", "hotel"),
+        "daily_hotel": count_by(data, "arrival_date", "hotel"),
+        "lead_time": count_by(data, "lead_time", "is_canceled", "hotel"),
+    }
+
+def merge_counts(table, removed, added) -> pl.DataFrame:
+    #Incremental update of a table of counts (like the cube): subtract the counts of the
+    #removed bookings, add the new ones and drop the combinations left empty.
+    keys = [c for c in table.columns if c != "count"]
+    parts = [table, removed.with_columns(-pl.col("count").cast(pl.Int64)), added]
+    # categorical keys as strings, the parts come from different frames
+    cats = [c for c in keys if table.schema[c] == pl.Categorical]
+    parts = [p.with_columns(pl.col("count").cast(pl.Int64), pl.col(cats).cast(pl.String)) for p in parts]
+    return pl.concat(parts).group_by(keys).agg(pl.col("count").sum()).filter(
+        pl.col("count") > 0).with_columns(pl.col("count").cast(pl.UInt32), pl.col(cats).cast(pl.Categorical))
+
+def cube_count(cube, *by) -> pl.DataFrame:
+    #Number of bookings for every combination of the dimensions in by.
+    return cube.group_by(by).agg(pl.col("count").sum()).sort(by)
+
+def cube_rate(cube, *by) -> pl.DataFrame:
+    #Number of bookings and cancellation rate for every combination of the dimensions in by.
+    return cube.group_by(by).agg(
+        pl.col("count").sum(),
+        ((pl.col("count") * pl.col("is_canceled")).sum() / pl.col("count").sum()).alias("cancel_rate"),
+    ).sort(by)
+
+def chart_tables(cube, series) -> dict:
+    #Grouped table of every chart of the EDA page, answered from the cube.
+    total = cube["count"].sum()
+    return {
+        "is_canceled": cube_count(cube, "is_canceled").with_columns(
+            (pl.col("count") / total).alias("proportion")),
+        "hotel_canceled": cube_count(cube, "hotel", "is_canceled"),
+        "adr_box": series["adr_box"],
+        "adr_bin": cube_rate(cube, "hotel", "adr_bin"),
+        "adr_daily": series["adr_daily"],
+        "monthly_hotel": cube_count(cube, "month", "hotel"),
+        "daily_hotel": series["daily_hotel"],
+        "monthly_canceled": cube_count(cube, "month", "is_canceled"),
+        "lead_time": series["lead_time"],
+        "booking_changes": cube_count(cube, "booking_changes", "is_canceled"),
+        "special_requests": cube_count(cube, "total_of_special_requests", "is_canceled"),
+        "repeated_guest": cube_count(cube, "is_repeated_guest", "is_canceled"),
+        "deposit": cube_count(cube, "deposit_type", "is_canceled"),
+        "deposit_rate": cube_rate(cube, "deposit_type"),
+    }
+
+def json_bytes(table) -> int:
+    #Approximate size of the table once serialized for Vega-Lite (list of records).
+    return len(table.write_json())
+
+def payload_report(data) -> pl.DataFrame:
+    #Bytes sent to the browser by every chart: whole dataset vs grouped table.
+    full = json_bytes(data)
+    tables = chart_tables(build_cube(data), build_series(data))
+    return pl.DataFrame({
+        "chart": list(tables),
+        "rows": [t.shape[0] for t in tables.values()],
+        "full_bytes": [full] * len(tables),
+        "aggregated_bytes": [json_bytes(t) for t in tables.values()],
+    }).with_columns(
+        (pl.col("full_bytes") / pl.col("aggregated_bytes")).round(0).alias("reduction")
+    )
+
+
+if __name__ == "__main__":
+    from preprocess import get_snapshot
+    with pl.Config(tbl_rows=-1):
+        print(payload_report(get_snapshot()))
@@ -2,7 +2,8 @@ import streamlit as st
 import polars as pl
 import altair as alt
 from preprocess import *
-from scipy.stats import chi2_contingency
+from aggregates import ADR_LABELS, chart_tables, cube_rate
+from profiler import checkpoint, fragment
 
 
 st.set_page_config(page_title="Hotel Bookings", page_icon="🏨", layout="centered")
@@ -12,14 +13,13 @@ cat_color = "category20"
 cat_color1 = "set2"
 sequential_color = "viridis"
 divergent_color = "redblue"
-
-
-# Load data
-data, world, joined = get_all()
+loess_bandwidth = LOESS_BANDWIDTH # bandwidth of the smoothing of the adr chart
 
 
 #### MAIN CODE ####
 
+checkpoint("presentazione")
+# title and introduction are drawn before the data is loaded
 st.title("EDA Prenotazioni Hotel")
 """
 Questo progetto ha come obiettivo l'analisi di un dataset di prenotazioni di hotel, si divide in 2 parti:
@@ -27,9 +27,17 @@ Questo progetto ha come obiettivo l'analisi di un dataset di prenotazioni di hot
 - Creazione di un modello di previsione
 ## Presentazione del dataset:
  """
-st.write("Il dataset contiene", data.shape[0], "prenotazioni e ", data.shape[1], "variabili, l'analisi si concentrerà solo su alcune di esse.")
 
-with  st.expander("Mostra summary dei dati ") : st.write(data.drop(pl.col("index")).describe())
+checkpoint("caricamento dati")
+# Load data: aggregate cube built once from the dataset, every section is answered from it
+version = dataset_version()
+cube, series = get_cube(version)
+# grouped tables of the charts (computed here, not in the browser)
+tables = chart_tables(cube, series)
+
+st.write("Il dataset contiene", series["shape"][0], "prenotazioni e ", series["shape"][1], "variabili, l'analisi si concentrerà solo su alcune di esse.")
+
+with  st.expander("Mostra summary dei dati ") : st.write(series["summary"])
 
 """
 Per maggiori informazioni sulle variabili del dataset consultare il README
@@ -38,13 +46,9 @@ In particolare ci chiediamo:
 - Quali variabili influenzano la cancellazione?"""
 
 
+checkpoint("grafici is_canceled e hotel")
 # bar chart is_canceled
-base = alt.Chart(data).transform_aggregate(
-    count='count()',
-    groupby=["is_canceled"]
-).transform_calculate(
-    proportion="datum.count / " + str(data.shape[0])
-)
+base = alt.Chart(tables["is_canceled"])
 
 chart = base.mark_bar().encode(
     alt.X("is_canceled:N", title="Cancellazione"),
@@ -71,24 +75,17 @@ ha un'influenza sulla cancellazione.
 """
 # bar chart hotel and is_canceled
 
-chart = alt.Chart(data).mark_bar().encode(
+chart = alt.Chart(tables["hotel_canceled"]).mark_bar().encode(
     alt.Y("is_canceled:N", title=""),
-    alt.X("count()", title="Numero Prenotazioni"),
+    alt.X("count:Q", title="Numero Prenotazioni"),
     alt.Facet("hotel:N", title=""),
     alt.Color("is_canceled:N", title="Cancellazione")
     ).properties(title="Cancellazione per tipo di hotel")
 st.altair_chart(chart, use_container_width=True)
 
-rate_city = round(data.filter(
-    (data["hotel"] == "City Hotel") & (data["is_canceled"] == 1)
-).shape[0] / data.filter(
-    data["hotel"] == "City Hotel"
-).shape[0] , 2)
-rate_resort = round(data.filter(
-    (data["hotel"] == "Resort Hotel") & (data["is_canceled"] == 1)
-).shape[0] / data.filter(
-    data["hotel"] == "Resort Hotel"
-).shape[0] , 2)
+rates = cube_rate(cube, "hotel")
+rate_city = round(rates.filter(pl.col("hotel") == "City Hotel")["cancel_rate"].item(), 2)
+rate_resort = round(rates.filter(pl.col("hotel") == "Resort Hotel")["cancel_rate"].item(), 2)
 
 st.write("Come possiamo vedere dal grafico, nel dataset ci " \
 "sono più prenotazioni su hotel di città e sempre quelli di città hanno un tasso di " \
@@ -103,15 +100,20 @@ proveremo in seguito ad indagare più a fondo.
 Vediamo ora come si distribuisce la variabile 'adr' (Average Daily Rate), 
 che rappresenta il prezzo medio per notte.
 """
+checkpoint("boxplot adr")
 # boxplot adr
 
-chart = alt.Chart(data).mark_boxplot().encode(
-    alt.X('adr:Q', title='Prezzo medio per notte (€)'),
-    alt.Facet("hotel:N", title = ""),
-    alt.Color("hotel:N", title="Tipo di hotel")
-).properties(
-    title="Distribuzione del prezzo medio per notte per tipo di hotel",
-    height = 50
+# statistics computed in polars, the layers draw whiskers, box, median and outliers
+box = alt.Chart().encode(alt.Color("hotel:N", title="Tipo di hotel"))
+chart = alt.layer(
+    box.mark_rule().encode(alt.X("lower:Q", title='Prezzo medio per notte (€)'), alt.X2("upper:Q")),
+    box.mark_bar(size=14).encode(alt.X("q1:Q"), alt.X2("q3:Q")),
+    box.mark_tick(color="white", size=14).encode(alt.X("median:Q")),
+    box.mark_point().encode(alt.X("outlier:Q")),
+    data=tables["adr_box"]
+).properties(height = 50).facet(
+    alt.Facet("hotel:N", title = ""), columns=2,
+    title="Distribuzione del prezzo medio per notte per tipo di hotel"
 )
 
 st.altair_chart(chart, use_container_width=True)
@@ -124,27 +126,15 @@ hanno un prezzo mediano maggiore rispetto ai resort ma con hanno una distribuzio
 rispetto ai resort. 
 """
 
-# prepare data for chart
-bins = [0.2,0.4,0.6,0.8]
-labels = ["(0, 65]", "(65, 85.5]","(85.5, 105.8]",
-           "(105.8, 135]", "(135, 510]"]
-temp = data.with_columns(
-    pl.col("adr").qcut(quantiles=bins,labels=labels).alias("adr_bin")
-)
-
-bin = temp.group_by("hotel","adr_bin").agg(
-    pl.col("is_canceled").mean().alias("cancellation_rate"),
-    pl.col("hotel").count().alias("count")
-    )
-
+checkpoint("bolle adr_bin")
 # buble chart adr_bin and hotel
-chart = alt.Chart(bin).mark_circle(size=100).encode(
-    alt.X("adr_bin:N", title="Prezzo medio per notte", sort = labels),
-    alt.Y("cancellation_rate:Q", title="tasso di cancellazione"),
+chart = alt.Chart(tables["adr_bin"]).mark_circle(size=100).encode(
+    alt.X("adr_bin:N", title="Prezzo medio per notte", sort = ADR_LABELS),
+    alt.Y("cancel_rate:Q", title="tasso di cancellazione"),
     alt.Size("count:Q", title="Numero Prenotazioni"),
     alt.Color("hotel:N", title="Tipo di hotel",
             scale=alt.Scale(scheme=cat_color)),
-    tooltip=["hotel:N","adr_bin:N","cancellation_rate:Q","count:Q"]
+    tooltip=["hotel:N","adr_bin:N","cancel_rate:Q","count:Q"]
 ).properties(title="Tasso di cancellazione per hotel e prezzo medio per notte (diviso in 5 intervalli)")
 st.altair_chart(chart, use_container_width=True)
 """
@@ -156,21 +146,20 @@ i resort hanno il tasso più basso mentre i city hotel il più alto.
 Aumentando il prezzo quello dei resort tende a salire mentre quello degli hotel di città tende a scendere.
 
 """
+checkpoint("adr nel tempo")
 # chart adr and arrival date, opaco
-chart = alt.Chart(data).mark_line(opacity = 0.4).encode(
+chart = alt.Chart(tables["adr_daily"]).mark_line(opacity = 0.4).encode(
     alt.X("arrival_date:T", title="Data di arrivo"),
-    alt.Y("median(adr):Q", title="Prezzo medio per notte"),
+    alt.Y("adr:Q", title="Prezzo medio per notte"),
     alt.Color("hotel:N", title="Tipo di hotel",
             scale=alt.Scale(scheme=cat_color)),
 ).properties(
     title="Andamento prezzo mediano (con smoothing)"
 )
-# add smoothing 
-chart1 = alt.Chart(data.to_pandas()).transform_loess(
-    "arrival_date", "adr", groupby=["hotel"], bandwidth=0.04
-).mark_line().encode(
+# add smoothing (loess computed on the server over the daily medians)
+chart1 = alt.Chart(get_smoothed_adr(loess_bandwidth, version)).mark_line().encode(
     alt.X("arrival_date:T"),
-    alt.Y("median(adr):Q"),
+    alt.Y("adr:Q"),
     alt.Color("hotel:N", title="Tipo di hotel")
     )
 st.altair_chart(chart + chart1, use_container_width=True)
@@ -185,12 +174,11 @@ il capodanno.
 Il prezzo degli hotel di città invece risultano più stabili e mediamente maggiori dei resort. 
 
 """
+checkpoint("prenotazioni nel tempo")
 # chart arrival date and n prenotations by hotel
-chart = alt.Chart(data.with_columns(
-    (pl.col("arrival_date").dt.strftime("%Y-%m")).alias("month")
-)).mark_line().encode(
+chart = alt.Chart(tables["monthly_hotel"]).mark_line().encode(
     alt.X("month:T",title="Data di arrivo"),
-    alt.Y("count()", title="Numero Prenotazioni"),
+    alt.Y("count:Q", title="Numero Prenotazioni"),
     alt.Color("hotel:N", title="Tipo di hotel",
             scale=alt.Scale(scheme=cat_color)),
 ).properties(title = "Serie storica: numero di prenotazioni per tipo di hotel")
@@ -200,8 +188,8 @@ i resort hanno una domanda quasi costante mentre quelli di città sembrerebbero
 più marcata stagionalità con 2 picchi annuali: a Ottobre e ad Aprile.
 Qui sotto vediamo come sono distribuiti nel tempo (in percentuale) nel dataset."""
 #area chart % n prenotation by hotel
-chart =alt.Chart(data).mark_area().encode(
-    y = alt.Y( "count()",title = "frequenza relativa n prenotazioni").stack("normalize"),
+chart =alt.Chart(tables["daily_hotel"]).mark_area().encode(
+    y = alt.Y( "count:Q",title = "frequenza relativa n prenotazioni").stack("normalize"),
     x = alt.X("arrival_date:T",title = "Data di arrivo"),
     color= alt.Color("hotel:N",scale = alt.Scale(scheme=cat_color))
 )
@@ -212,12 +200,11 @@ marcata rispetto al primo grafico perché le prenotazioni non sono stare aggrega
 Vediamo come si comporta la variabile di nostro interesse nel tempo:
 """
 
+checkpoint("cancellazioni nel tempo")
 # n canceled and not chart
-chart = alt.Chart(data.with_columns(
-    (pl.col("arrival_date").dt.strftime("%Y-%m")).alias("month")
-)).mark_line().encode(
+chart = alt.Chart(tables["monthly_canceled"]).mark_line().encode(
     alt.X("month:T",title="Data di arrivo"),
-    alt.Y("count()", title="Numero Prenotazioni",),
+    alt.Y("count:Q", title="Numero Prenotazioni",),
     alt.Color("is_canceled:N", title="Cancellazione",
             scale=alt.Scale(scheme=cat_color1)),
 ).properties(title = "Serie storica numero di prenotazioni: cancellate e non cancellate")
@@ -234,10 +221,11 @@ quelle cancellate, con andamenti paralleli che evidenziano una stagionalità sim
  """
 
 
+checkpoint("lead time")
 # chart lead time and type of hotel
-chart = alt.Chart(data).mark_area().encode(
+chart = alt.Chart(tables["lead_time"]).mark_area().encode(
     alt.X("lead_time:Q", title="Lead time", scale  = alt.Scale(domain=[0, 630])),
-    alt.Y("count()", title="Numero Prenotazioni"),
+    alt.Y("count:Q", title="Numero Prenotazioni"),
     alt.Color("is_canceled:N", title="Cancellazione",
             scale=alt.Scale(scheme=cat_color1)),
     alt.Facet("hotel:N")
@@ -257,39 +245,47 @@ Ci chiediamo ora se la provenienza del cliente possa essere o meno un'informazio
 vediamo come si distribuiscono le prenotazioni nel nostro dataset con il seguente grafico (interativo):
 """
 
-if  st.selectbox("Vuoi visualizzare la distribuzione delle prenotazioni in tutto il mondo o solo in Europa", [ "Europa","Mondo"]) == "Europa":
-    map_type = "azimuthalEqualArea"
-    center = (10, 48)
-    scale = 800
-else:
-    map_type = "equalEarth" 
-    center = (0, 0)
-    scale = 150 
-
-if st.checkbox("Escludendo il Portogallo? ", [False, True]) == False:
-    maxdomain = 47651
-else:
-    maxdomain = 12073
-
-chart = alt.Chart(world).mark_geoshape(color= "lightgray").properties(width=600, height=600).project(
-    type= map_type,
-    scale = scale,
-    center=center
-)
+checkpoint("mappa prenotazioni")
+# the map is a fragment: its widgets rerun only this function, the html is cached by the options
+@fragment("mappa prenotazioni")
+def bookings_map():
+    if  st.selectbox("Vuoi visualizzare la distribuzione delle prenotazioni in tutto il mondo o solo in Europa", [ "Europa","Mondo"]) == "Europa":
+        map_type = "azimuthalEqualArea"
+        center = (10, 48)
+        scale = 800
+    else:
+        map_type = "equalEarth" 
+        center = (0, 0)
+        scale = 150 
+    world, joined = get_maps(map_type, version)
+
+    exclude_portugal = st.checkbox("Escludendo il Portogallo? ", [False, True])
+    if exclude_portugal == False:
+        maxdomain = 47651
+    else:
+        maxdomain = 12073
+
+    chart = alt.Chart(world).mark_geoshape(color= "lightgray").properties(width=600, height=600).project(
+        type= map_type,
+        scale = scale,
+        center=center
+    )
 
-mappa = alt.Chart(joined).mark_geoshape().encode(
-    color=alt.Color("count:Q", scale=alt.Scale(scheme=sequential_color, domain = [0,maxdomain]),legend=alt.Legend(title="Prenotazioni", orient="top-left")),
-    tooltip=["country:N", "count:Q"]
-).project(
-    type= map_type,
-    scale=scale,
-    center=center
-).properties(
-    width=600,
-    height=600,
-    title="Mappa prenotazioni"
-)
-add_map(chart + mappa)
+    mappa = alt.Chart(joined).mark_geoshape().encode(
+        color=alt.Color("count:Q", scale=alt.Scale(scheme=sequential_color, domain = [0,maxdomain]),legend=alt.Legend(title="Prenotazioni", orient="top-left")),
+        tooltip=["country:N", "count:Q"]
+    ).project(
+        type= map_type,
+        scale=scale,
+        center=center
+    ).properties(
+        width=600,
+        height=600,
+        title="Mappa prenotazioni"
+    )
+    add_map(chart + mappa, "prenotazioni", map_type, exclude_portugal, version)
+
+bookings_map()
 """
 La mappa mostra la distribuzione delle prenotazioni in tutto il mondo,
 vediamo che la maggior parte delle prenotazioni proviene da paesi europei, in particolare dal Portogallo (si può visualizzare 
@@ -299,39 +295,46 @@ Ora vediamo come varia il tasso di cancellazione, con il seguente grafico, (sele
 l'informazione sulla numerosità, ATTENZIONE è in scala logaritmica) :
 
 """
-if st.selectbox("Seleziona mondo o europa", [ "Europa","Mondo"]) == "Europa":
-    map_type = "azimuthalEqualArea"
-    center = (10, 48)
-    scale = 800
-else:
-    map_type = "equalEarth" 
-    center = (0, 0)
-    scale = 150 
-base = alt.Chart(world).mark_geoshape(color="lightgray").properties(width=600, height=600).project(
-    type=map_type,
-    scale=scale,
-    center=center
-)
+checkpoint("mappa cancellazioni")
+@fragment("mappa cancellazioni")
+def cancellations_map():
+    if st.selectbox("Seleziona mondo o europa", [ "Europa","Mondo"]) == "Europa":
+        map_type = "azimuthalEqualArea"
+        center = (10, 48)
+        scale = 800
+    else:
+        map_type = "equalEarth" 
+        center = (0, 0)
+        scale = 150 
+    world, joined = get_maps(map_type, version)
+    base = alt.Chart(world).mark_geoshape(color="lightgray").properties(width=600, height=600).project(
+        type=map_type,
+        scale=scale,
+        center=center
+    )
 
-mappa = alt.Chart(joined).mark_geoshape().encode(
-    color=alt.Color("rate_cancelled:Q", scale=alt.Scale(scheme=sequential_color),
-                legend=alt.Legend(title="Tasso di Cancellazione", format=".2%",orient="top-left")),
-    tooltip=["country:N", alt.Tooltip("rate_cancelled:Q", format=".2%"), "count:Q"]
-).project(
-    type=map_type,
-    scale=scale,
-    center=center
-).properties(
-    width=600,
-    height=600,
-    title="Tasso di Cancellazione"
-)
+    mappa = alt.Chart(joined).mark_geoshape().encode(
+        color=alt.Color("rate_cancelled:Q", scale=alt.Scale(scheme=sequential_color),
+                    legend=alt.Legend(title="Tasso di Cancellazione", format=".2%",orient="top-left")),
+        tooltip=["country:N", alt.Tooltip("rate_cancelled:Q", format=".2%"), "count:Q"]
+    ).project(
+        type=map_type,
+        scale=scale,
+        center=center
+    ).properties(
+        width=600,
+        height=600,
+        title="Tasso di Cancellazione"
+    )
 
-if st.checkbox("Inclusione della numerosità delle prenotazioni (in scala logaritmica) ", [False, True]) == True:
-    mappa = mappa.encode(opacity=alt.Opacity('count:Q', scale=alt.Scale(type = "log",range=[0,1]),
-                 legend=alt.Legend(title="Numero Prenotazioni",orient="top-left", format=".0f")))
+    log_opacity = st.checkbox("Inclusione della numerosità delle prenotazioni (in scala logaritmica) ", [False, True])
+    if log_opacity == True:
+        mappa = mappa.encode(opacity=alt.Opacity('count:Q', scale=alt.Scale(type = "log",range=[0,1]),
+                     legend=alt.Legend(title="Numero Prenotazioni",orient="top-left", format=".0f")))
 
-add_map(base + mappa)
+    add_map(base + mappa, "cancellazioni", map_type, log_opacity, version)
+
+cancellations_map()
 
 """
 L'analisi del grafico rivela che il Portogallo, nazione con più prenotazioni, presenta uno dei tassi di cancellazione più elevati tra i Paesi visualizzati, 
@@ -351,26 +354,24 @@ specialmente se orientati verso hotel di fascia di prezzo più alta.
 
 Tabella di tutte le prenotazioni:
 """
-temp = data.with_columns(
-    pl.when(pl.col("country") == "PRT").then(pl.lit("Portogallo")).otherwise(pl.lit("Altri Paesi")).alias("country")
-).group_by("country").agg(
-    pl.len().alias("numero di prenotazioni"),pl.col("is_canceled").mean().alias("tasso di cancellazione"))
+checkpoint("tabelle Portogallo e chi-quadro")
+portugal = cube.with_columns(
+    pl.when(pl.col("country") == "PRT").then(pl.lit("Portogallo")).otherwise(pl.lit("Altri Paesi")).alias("country"))
+names = {"count": "numero di prenotazioni", "cancel_rate": "tasso di cancellazione"}
+temp = cube_rate(portugal, "country").rename(names)
 st.write( temp )
 """
 Tabella hotel di città con adr <= 65:
 """
-temp1 = data.filter((pl.col("adr")<=65) & (pl.col("hotel") == "City Hotel")).with_columns(
-    pl.when(pl.col("country") == "PRT").then(pl.lit("Portogallo")).otherwise(pl.lit("Altri Paesi")).alias("country")
-).group_by("country").agg(
-    pl.len().alias("numero di prenotazioni"), pl.col("is_canceled").cast(pl.Float64).mean().alias("tasso di cancellazione"))
+# adr <= 65 is the first adr bin
+temp1 = cube_rate(portugal.filter((pl.col("adr_bin") == ADR_LABELS[0]) & (pl.col("hotel") == "City Hotel")),
+    "country").rename(names)
 st.write( temp1 )
 """
 Tabella Resort Hotel con adr <= 65:
 """
-temp2 = data.filter((pl.col("adr")<=65) & (pl.col("hotel") == "Resort Hotel")).with_columns(
-    pl.when(pl.col("country") == "PRT").then(pl.lit("Portogallo")).otherwise(pl.lit("Altri Paesi")).alias("country")
-).group_by("country").agg(
-    pl.len().alias("numero di prenotazioni"), pl.col("is_canceled").cast(pl.Float64).mean().alias("tasso di cancellazione"))
+temp2 = cube_rate(portugal.filter((pl.col("adr_bin") == ADR_LABELS[0]) & (pl.col("hotel") == "Resort Hotel")),
+    "country").rename(names)
 st.write( temp2 )
 
 observed = pl.concat([temp1,temp2]).select(pl.col("numero di prenotazioni")).to_numpy().reshape(2,2)
@@ -398,9 +399,9 @@ a quelli dei Resort, si potrebbe approfondire la seguente relazione andando ad i
 """
 
 
+checkpoint("booking changes")
 # book changes
-chart = bar_chart(data.with_columns(pl.when(pl.col("booking_changes")>1).then(pl.lit("2+")).otherwise("booking_changes").alias("booking_changes")), 
- "booking_changes","count()", "is_canceled", cat_color1)
+chart = bar_chart(tables["booking_changes"], "booking_changes","count:Q", "is_canceled", cat_color1)
 
 st.altair_chart(chart, use_container_width=True)
 """
@@ -412,9 +413,9 @@ sia un cliente più attento o propenso a soggiornare e quindi sia meno incline a
 Ora proviamo a verificare se c'è una qualche associazione tra il numero di richieste speciali e le cancellazioni.
 """
 
+checkpoint("richieste speciali")
 # total_of_special_requests
-chart = bar_chart(data.with_columns(pl.when((pl.col("total_of_special_requests"))>1).then(pl.lit("2+")).otherwise("total_of_special_requests").alias("total_of_special_requests"))
-    , "total_of_special_requests","count()","is_canceled", cat_color1)
+chart = bar_chart(tables["special_requests"], "total_of_special_requests","count:Q","is_canceled", cat_color1)
 st.altair_chart(chart, use_container_width=True)
 """
 Anche in questo caso, il grafico ci suggerisce che più richieste si associano a meno cancellazioni, infatti i clienti con 0 richieste speciali 
@@ -425,10 +426,11 @@ Osserviamo ora se il comportamento dei clienti abituali possa essere un informaz
 Si precisa che il numero di prenotazioni fatte da clienti abituali nel dataset è di soli 3497.
 """
 
+checkpoint("clienti abituali")
 col1, col2 = st.columns(2)# is_repeated_guest
 with col1:
-    chart = alt.Chart(data.filter(pl.col("is_repeated_guest")==0)).mark_arc().encode(
-        theta=alt.Theta("count()"),
+    chart = alt.Chart(tables["repeated_guest"].filter(pl.col("is_repeated_guest")==0)).mark_arc().encode(
+        theta=alt.Theta("count:Q"),
         color=alt.Color(
             "is_canceled:N",
             scale=alt.Scale(scheme = cat_color1),
@@ -437,8 +439,8 @@ with col1:
     ).properties(title = "Nuovo cliente") 
     st.altair_chart(chart, use_container_width=True)
 with col2:
-    chart1 = alt.Chart(data.filter(pl.col("is_repeated_guest")==1)).mark_arc().encode(
-        theta=alt.Theta("count()"),
+    chart1 = alt.Chart(tables["repeated_guest"].filter(pl.col("is_repeated_guest")==1)).mark_arc().encode(
+        theta=alt.Theta("count:Q"),
         color=alt.Color(
             "is_canceled:N",
             scale=alt.Scale(scheme = cat_color1),
@@ -461,31 +463,12 @@ Per l'analisi sono state divise le prenotazioni in 4 gruppi ossia:
 - Clienti con sia cancellazioni passate che non, essendo poche osservazioni non è stato
   considerato quale delle 2 è maggiore.
 """
-# preparation data
-temp = data.filter(pl.col("is_canceled") == 1).with_columns(
-    pl.when(pl.col("previous_cancellations") > 0).then(pl.lit("CANCELLAZIONI PASSATE")).otherwise(pl.lit("NO CANCELLAZIONI PASSATE")).alias("previous_cancellations"),
-    pl.when(pl.col("previous_bookings_not_canceled") > 0).then(pl.lit("PRENOTAZIONI PASSATE")).otherwise(pl.lit("NO PRENOTAZIONI PASSATE")).alias("previous_bookings_not_canceled")
-).group_by(
-    pl.col("previous_cancellations"),
-    pl.col("previous_bookings_not_canceled")
-).agg(
-    pl.len().alias("count"))
-temp_total = data.with_columns(
-    pl.when(pl.col("previous_cancellations") > 0).then(pl.lit("CANCELLAZIONI PASSATE")).otherwise(pl.lit("NO CANCELLAZIONI PASSATE")).alias("previous_cancellations"),
-    pl.when(pl.col("previous_bookings_not_canceled") > 0).then(pl.lit("PRENOTAZIONI PASSATE")).otherwise(pl.lit("NO PRENOTAZIONI PASSATE")).alias("previous_bookings_not_canceled")
-).group_by(
-    pl.col("previous_cancellations"),
-    pl.col("previous_bookings_not_canceled")
-).agg(
-    pl.len().alias("count"))
-
-temp_join = temp_total.join(temp,left_on=["previous_cancellations","previous_bookings_not_canceled"],
-    right_on=["previous_cancellations","previous_bookings_not_canceled"])
-temp_join = temp_join.with_columns(
-    (pl.col("count_right")/pl.col("count")).alias("rate")
-)
-
-temp_join.drop_in_place("count_right")
+checkpoint("heatmap")
+# preparation data (in the cube the two variables are already flags: > 0)
+temp_join = cube_rate(cube, "previous_cancellations", "previous_bookings_not_canceled").with_columns(
+    pl.when(pl.col("previous_cancellations")).then(pl.lit("CANCELLAZIONI PASSATE")).otherwise(pl.lit("NO CANCELLAZIONI PASSATE")).alias("previous_cancellations"),
+    pl.when(pl.col("previous_bookings_not_canceled")).then(pl.lit("PRENOTAZIONI PASSATE")).otherwise(pl.lit("NO PRENOTAZIONI PASSATE")).alias("previous_bookings_not_canceled")
+).rename({"cancel_rate": "rate"})
 
 # Heatmap and text
 chart = alt.Chart(temp_join).mark_rect().encode(
@@ -530,16 +513,17 @@ Oltre a quanto detto un hotel potrebbe valutare come politica per la riduzione d
 l'inserimento o meno di una cauzione, rimborsabile o non.
 Per valutare ciò osserviamo che informazioni può dare la variabile deposit_type:
 """
+checkpoint("deposito")
 # deposity_type
-count_chart = alt.Chart(data).mark_bar().encode(
+count_chart = alt.Chart(tables["deposit"]).mark_bar().encode(
     x=alt.X('deposit_type:N', title='Tipo di Cauzione'),
-    y=alt.Y('count()', title='Numero di Prenotazioni'),
+    y=alt.Y('count:Q', title='Numero di Prenotazioni'),
     color=alt.Color('is_canceled:O', title='Stato Prenotazione',
                     scale=alt.Scale( scheme = cat_color1)),
     tooltip=[
         alt.Tooltip('deposit_type:N', title='Tipo Cauzione'),
         alt.Tooltip('is_canceled:O', title='Cancellata?'),
-        alt.Tooltip('count()', title='Conteggio')
+        alt.Tooltip('count:Q', title='Conteggio')
     ]
 ).properties(
     title='Prenotazioni e Cancellazioni per Tipo di Cauzione',
@@ -547,10 +531,7 @@ count_chart = alt.Chart(data).mark_bar().encode(
 )
 
 # rate cancellation chart by deposit_type
-rate_chart = alt.Chart(data).transform_aggregate(
-    cancel_rate='mean(is_canceled)', 
-    groupby=['deposit_type']
-).mark_bar().encode(
+rate_chart = alt.Chart(tables["deposit_rate"]).mark_bar().encode(
     x=alt.X('deposit_type:N', title='Tipo di Cauzione'),
     y=alt.Y('cancel_rate:Q', title='Tasso di Cancellazione', axis=alt.Axis(format='%')),
     tooltip=[
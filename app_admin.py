@@ -0,0 +1,54 @@
+import streamlit as st
+import polars as pl
+from cache import MEMORY_CACHE
+from preprocess import get_prediction_cache
+from profiler import checkpoint
+
+# Admin page (HOTEL_ADMIN=1): memory used by the cached loaders against the budget,
+# hits, misses and evictions per function, the entries in LRU order and the buttons to empty them.
+
+st.title("Cache del server")
+st.markdown("Dati, mappe, grafici e modelli in memoria, condivisi da tutte le sessioni. "
+    "Oltre il budget (`HOTEL_CACHE_MB`) vengono rimossi gli elementi usati meno di recente.")
+
+stats = MEMORY_CACHE.stats()
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Memoria usata", f"{stats['used'] / 2**20:.0f} MB", f"{stats['used'] * 100 / stats['budget']:.0f}% del budget", delta_color="off")
+col2.metric("Elementi", stats["entries"])
+col3.metric("Hit rate", f"{stats['hit_rate']:.1%}")
+col4.metric("Rimozioni", stats["evictions"])
+st.progress(min(stats["used"] / stats["budget"], 1.0), text=f"Budget: {stats['budget'] / 2**20:.0f} MB")
+
+checkpoint("funzioni")
+st.subheader("Per funzione")
+functions = pl.DataFrame(stats["functions"], schema={"function": pl.String, "entries": pl.Int64, "bytes": pl.Int64,
+    "hits": pl.Int64, "misses": pl.Int64, "evictions": pl.Int64, "oversize": pl.Int64, "max_entries": pl.Int64, "hit_rate": pl.Float64})
+st.dataframe(functions.with_columns(MB=pl.col("bytes") / 2**20).drop("bytes").sort("MB", descending=True),
+    hide_index=True, column_config={
+        "function": "Funzione", "entries": "Elementi", "hits": "Hit", "misses": "Miss", "evictions": "Rimozioni",
+        "oversize": st.column_config.NumberColumn("Oltre il budget", help="Risultati più grandi del budget, non tenuti in cache"),
+        "max_entries": "Max elementi",
+        "hit_rate": st.column_config.ProgressColumn("Hit rate", min_value=0, max_value=1, format="percent"),
+        "MB": st.column_config.NumberColumn(format="%.1f")})
+
+st.subheader("Elementi")
+st.caption("Dal meno usato di recente (il primo ad essere rimosso)")
+st.dataframe([{"funzione": row["function"], "argomenti": row["key"], "MB": row["bytes"] / 2**20} for row in stats["keys"]],
+    hide_index=True, column_config={"MB": st.column_config.NumberColumn(format="%.1f")})
+
+col1, col2 = st.columns(2)
+with col1:
+    name = st.selectbox("Funzione", [f["function"] for f in stats["functions"]])
+    if st.button("Svuota la funzione", disabled=name is None):
+        MEMORY_CACHE.clear(name)
+        st.rerun()
+with col2:
+    st.write("")
+    if st.button("Svuota tutta la cache", type="primary"):
+        MEMORY_CACHE.clear()
+        st.rerun()
+
+checkpoint("previsioni")
+st.subheader("Cache delle previsioni")
+predictions = get_prediction_cache().stats()
+st.dataframe([predictions], hide_index=True)
@@ -1,25 +1,49 @@
+import os
+import shutil
+import tempfile
+
 import streamlit as st
-from preprocess import get_model
+from preprocess import (ALGORITHMS, get_encoders, get_metrics, get_model, get_prediction_cache, get_predictor,
+    model_version, trained_algorithms)
+from encoders import encode, to_matrix
+from cache import cached
+from scoring import ScoredFile, derive_features, remove_file, score_file, what_if
+from profiler import checkpoint, fragment, section
 import altair as alt
 import polars as pl
-model, metrics, label_encoder = get_model()
+checkpoint("caricamento metriche")
+# models trained with trainmodel.py --algorithm (the random forest if only that one exists)
+algorithm = st.sidebar.selectbox("Modello", trained_algorithms() or ["rf"], format_func=lambda a: ALGORITHMS[a]["name"])
+# only the small artifacts: the model is loaded at the first prediction
+metrics = get_metrics(algorithm)
+label_encoder = get_encoders()
 
 st.title("Modello per Previsione")
-"""
-Utilizzando i dati mostrati nella pagina precedente, è stato addestrato un modello di classificazione con una Random Forest
+st.markdown(f"""
+Utilizzando i dati mostrati nella pagina precedente, è stato addestrato un modello di classificazione con una {ALGORITHMS[algorithm]["name"]}
 per prevedere se una prenotazione sarà cancellata o meno.
 Qui di seguito sono riportate le metriche del modello e un tool per visualizzare le previsioni su nuove prenotazioni.
-"""
+Se sono stati addestrati più modelli si può scegliere quale usare nella barra laterale.
+""")
+checkpoint("metriche")
 # MODEL METRICS 
 """ ### Metriche test del modello
 """
 classification_report = metrics["classification_report"]
 weighted_avg = classification_report["weighted avg"]
  
-"""
-Le metriche qui riportate sono state calcolate su un campione (test set) pari al 20% del totale dei dati.
+evaluation = metrics.get("evaluation", {"mode": "holdout", "test_size": 0.2})
+if evaluation["mode"] == "oof":
+    st.markdown(f"""
+Le metriche qui riportate sono state calcolate sulle previsioni out-of-fold di una cross-validation a {evaluation['folds']} fold:
+ogni prenotazione è prevista dal modello che non l'ha vista in addestramento, quindi il campione è l'intero dataset.
 Per ulteriori informazioni guardare (?) affianco alla metrica.
-""" 
+""")
+else:
+    st.markdown(f"""
+Le metriche qui riportate sono state calcolate su un campione (test set) pari al {evaluation['test_size']:.0%} del totale dei dati.
+Per ulteriori informazioni guardare (?) affianco alla metrica.
+""")
 col1, col2, col3, col4, col5 = st.columns(5)
 
 with col1:
@@ -99,6 +123,7 @@ rispetto a quello di "Non Cancellato", questo potrebbe essere un punto di miglio
 a prevedere il maggior numero di cancellazioni possibili.
 """
 
+checkpoint("curva ROC")
 # ROC Curve
 roc_data = metrics['roc_curve']
 roc_df = pl.DataFrame({
@@ -128,11 +153,12 @@ line_chart = alt.Chart(line_df).mark_line(color='gray', strokeDash=[3, 3]).encod
 )
 
 st.altair_chart(roc_chart+line_chart, use_container_width=True)
-"""
+st.markdown(f"""
 Qui sopra viene riportato la curva ROC, ossia la curva che mostra il trade-off tra il tasso di veri positivi (TPR) e
  il tasso di falsi positivi (FPR) per diversi valori di soglia di classificazione. 
- Maggiore è l'area sotto la curva (AUC = 96.2%), migliore è la capacità del modello di distinguere tra le classi.
- """
+ Maggiore è l'area sotto la curva (AUC = {metrics['auc_score']:.1%}), migliore è la capacità del modello di distinguere tra le classi.
+ """)
+checkpoint("importanza variabili")
 # Feature Importance
 feature_importance = metrics['feature_importance']
 
@@ -152,6 +178,8 @@ feature_chart = alt.Chart(feature_df, title='Importanza delle Variabili'
     ).properties(title='Importanza delle Variabili')
 
 st.altair_chart(feature_chart, use_container_width=True)
+if metrics.get("algorithm", "rf") != "rf":
+    st.caption("Per questo modello l'importanza è calcolata per permutazione: calo dell'AUC quando si mescolano i valori della variabile su un campione di prenotazioni.")
 """
 Questa sezione illustra quanto ciascuna variabile influenzi le previsioni del modello.
 Le variabili con un valore più elevato sono quelle che contribuiscono maggiormente al modello. 
@@ -161,6 +189,7 @@ nella fase di esplorazione iniziale dei dati.
 
 """
 
+checkpoint("matrice di confusione")
 confusion_matrix = metrics['confusion_matrix']
 confusion_df = pl.DataFrame({
     'Reale': ["Non cancellato", "Non cancellato", "Cancellato", "Cancellato"],
@@ -212,6 +241,7 @@ Ora vediamo la cross-validation del modello, che ci permette di valutare le pres
 robusta.
 
 """
+checkpoint("cross validation")
 cv_metrics = metrics['cv_scores']
 # Cross Validation Section
 
@@ -262,169 +292,248 @@ possiamo notare che quasi tutte le metriche sono molto simili a quelle del test
 InseriRE i dati di una nuova prenotazione:
 """
 
-# Create prediction form
-with st.form("prediction_form"):
-    st.subheader("Inserisci i dati della prenotazione")
+checkpoint("form previsione")
+# values of the what-if curves (same ranges of the form)
+WHAT_IF_VALUES = {
+    "lead_time": list(range(0, 738, 4)),
+    "adr": [i * 2.5 for i in range(201)],
+    "total_of_special_requests": list(range(6)),
+}
+WHAT_IF_LABELS = {"lead_time": "Lead Time (giorni)", "adr": "ADR", "total_of_special_requests": "Richieste speciali"}
+
+@cached(max_entries=64)
+def get_what_if(base, field, algorithm, version):
+    # one batched prediction for the whole grid, cached per base booking, field and model
+    return what_if(get_predictor(algorithm), label_encoder, metrics["feature_names"], dict(base), field, WHAT_IF_VALUES[field])
+
+@fragment("what-if")
+def what_if_panel():
+    # nested fragment: changing the field reruns only the curves, the result of the form stays
+    if "base_booking" not in st.session_state:
+        return
+    st.markdown("""
+### Analisi what-if
+
+Come cambia la probabilità di cancellazione dell'ultima prenotazione inserita se varia una sola caratteristica, 
+per ogni tipo di deposito (la linea verticale è il valore inserito):
+""")
+    base = st.session_state["base_booking"]
+    field = st.selectbox("Caratteristica", list(WHAT_IF_VALUES), format_func=lambda f: WHAT_IF_LABELS[f])
+    with section("what_if"):
+        curves = get_what_if(tuple(base.items()), field, algorithm, model_version(algorithm=algorithm))
+    what_if_chart = alt.Chart(curves).mark_line(point=(field == "total_of_special_requests")).encode(
+        x=alt.X(f"{field}:Q", title=WHAT_IF_LABELS[field]),
+        y=alt.Y("cancel_probability:Q", title="Probabilità di cancellazione", axis=alt.Axis(format="%"), scale=alt.Scale(domain=[0, 1])),
+        color=alt.Color("deposit_type:N", title="Tipo Deposito"),
+        tooltip=[f"{field}:Q", "deposit_type:N", alt.Tooltip("cancel_probability:Q", format=".1%")],
+    )
+    base_rule = alt.Chart(pl.DataFrame({field: [base[field]]})).mark_rule(color="gray", strokeDash=[3, 3]).encode(x=f"{field}:Q")
+    st.altair_chart(what_if_chart + base_rule, use_container_width=True)
+
+# the form, its result and the what-if are a fragment: a submission reruns only this part of the page
+@fragment("form previsione")
+def prediction_tool():
+    # Create prediction form
+    with st.form("prediction_form"):
+        st.subheader("Inserisci i dati della prenotazione")
     
-    # Create columns FOR layout
-    col1, col2, col3 = st.columns(3)
+        # Create columns FOR layout
+        col1, col2, col3 = st.columns(3)
     
-    with col1:
-        st.markdown("**Dati Generali**")
-        lead_time = st.number_input("Lead Time (giorni)", min_value=0, max_value=737, value=50, 
-                                   help="Giorni tra prenotazione e arrivo")
+        with col1:
+            st.markdown("**Dati Generali**")
+            lead_time = st.number_input("Lead Time (giorni)", min_value=0, max_value=737, value=50, 
+                                       help="Giorni tra prenotazione e arrivo")
                 
-        arrival_date_week_number = st.number_input("Settimana dell'Anno", min_value=1, max_value=53, value=27)
+            arrival_date_week_number = st.number_input("Settimana dell'Anno", min_value=1, max_value=53, value=27)
         
-        stays_in_weekend_nights = st.number_input("Notti Weekend", min_value=0, max_value=19, value=1)
+            stays_in_weekend_nights = st.number_input("Notti Weekend", min_value=0, max_value=19, value=1)
         
-        stays_in_week_nights = st.number_input("Notti Settimana", min_value=0, max_value=50, value=2)
+            stays_in_week_nights = st.number_input("Notti Settimana", min_value=0, max_value=50, value=2)
         
-        adults = st.number_input("Adulti", min_value=0, max_value=55, value=2)
+            adults = st.number_input("Adulti", min_value=0, max_value=55, value=2)
         
-        children = st.number_input("Bambini", min_value=0, max_value=10, value=0)
+            children = st.number_input("Bambini", min_value=0, max_value=10, value=0)
         
-        babies = st.number_input("Neonati", min_value=0, max_value=10, value=0)
+            babies = st.number_input("Neonati", min_value=0, max_value=10, value=0)
     
-    with col2:
-        st.markdown("**Dati Hotel**")
-        hotel = st.selectbox("Tipo Hotel", list(label_encoder['hotel'].classes_))
+        with col2:
+            st.markdown("**Dati Hotel**")
+            hotel = st.selectbox("Tipo Hotel", label_encoder['hotel'])
         
-        meal = st.selectbox("Tipo Pasto", list(label_encoder['meal'].classes_))
+            meal = st.selectbox("Tipo Pasto", label_encoder['meal'])
         
-        country = st.selectbox("Paese", list(label_encoder['country'].classes_))
+            country = st.selectbox("Paese", label_encoder['country'])
         
-        market_segment = st.selectbox("Segmento Mercato", list(label_encoder['market_segment'].classes_))
+            market_segment = st.selectbox("Segmento Mercato", label_encoder['market_segment'])
         
-        distribution_channel = st.selectbox("Canale Distribuzione", list(label_encoder['distribution_channel'].classes_))
+            distribution_channel = st.selectbox("Canale Distribuzione", label_encoder['distribution_channel'])
         
-        reserved_room_type = st.selectbox("Tipo Camera Prenotata", list(label_encoder['reserved_room_type'].classes_))
+            reserved_room_type = st.selectbox("Tipo Camera Prenotata", label_encoder['reserved_room_type'])
         
-        assigned_room_type = st.selectbox("Tipo Camera Assegnata", list(label_encoder['assigned_room_type'].classes_))
+            assigned_room_type = st.selectbox("Tipo Camera Assegnata", label_encoder['assigned_room_type'])
     
-    with col3:
-        st.markdown("**Dati Prenotazione**")
-        booking_changes = st.number_input("Modifiche Prenotazione", min_value=0, max_value=21, value=0)
+        with col3:
+            st.markdown("**Dati Prenotazione**")
+            booking_changes = st.number_input("Modifiche Prenotazione", min_value=0, max_value=21, value=0)
         
-        deposit_type = st.selectbox("Tipo Deposito", list(label_encoder['deposit_type'].classes_))
+            deposit_type = st.selectbox("Tipo Deposito", label_encoder['deposit_type'])
         
-        days_in_waiting_list = st.number_input("Giorni in Lista d'Attesa", min_value=0, max_value=391, value=0)
+            days_in_waiting_list = st.number_input("Giorni in Lista d'Attesa", min_value=0, max_value=391, value=0)
         
-        customer_type = st.selectbox("Tipo Cliente", list(label_encoder['customer_type'].classes_))
+            customer_type = st.selectbox("Tipo Cliente", label_encoder['customer_type'])
         
-        adr = st.number_input("ADR", min_value=0.0, max_value=5400.0, value=100.0, step=0.5,
-                             help="Average Daily Rate (Tariffa Media)")
+            adr = st.number_input("ADR", min_value=0.0, max_value=5400.0, value=100.0, step=0.5,
+                                 help="Average Daily Rate (Tariffa Media)")
         
-        required_car_parking_spaces = st.number_input("Posti auto richiesti", min_value=0, max_value=8, value=0)
+            required_car_parking_spaces = st.number_input("Posti auto richiesti", min_value=0, max_value=8, value=0)
         
-        total_of_special_requests = st.number_input("Richieste speciali", min_value=0, max_value=5, value=0)
+            total_of_special_requests = st.number_input("Richieste speciali", min_value=0, max_value=5, value=0)
         
-        is_repeated_guest = st.selectbox("Cliente abituale", [0, 1], format_func = lambda x: "Sì" if x == 1 else "No")
+            is_repeated_guest = st.selectbox("Cliente abituale", [0, 1], format_func = lambda x: "Sì" if x == 1 else "No")
         
-        previous_cancellations = st.number_input("Cancellazioni precedenti", min_value=0, max_value= 50, value=0)
+            previous_cancellations = st.number_input("Cancellazioni precedenti", min_value=0, max_value= 50, value=0)
         
-        previous_bookings_not_canceled = st.number_input("Prenotazioni precedenti non cancellate", min_value=0, max_value=50, value=0)
+            previous_bookings_not_canceled = st.number_input("Prenotazioni precedenti non cancellate", min_value=0, max_value=50, value=0)
     
-    # Submit button
-    submitted = st.form_submit_button("🔍 Predici Cancellazione", type="primary")
-    if submitted:
-        # Prepare input data
-        input_data = {
-            'hotel': hotel,
-            'lead_time': lead_time,
-            'arrival_date_week_number': arrival_date_week_number,
-            'stays_in_weekend_nights': stays_in_weekend_nights,
-            'stays_in_week_nights': stays_in_week_nights,
-            'adults': adults,
-            'children': children,
-            'babies': babies,
-            'meal': meal,
-            'country': country,
-            'market_segment': market_segment,
-            'distribution_channel': distribution_channel,
-            'is_repeated_guest': is_repeated_guest,
-            'previous_cancellations': previous_cancellations,
-            'previous_bookings_not_canceled': previous_bookings_not_canceled,
-            'reserved_room_type': reserved_room_type,
-            'assigned_room_type': assigned_room_type,
-            'booking_changes': booking_changes,
-            'deposit_type': deposit_type,
-            'days_in_waiting_list': days_in_waiting_list,
-            'customer_type': customer_type,
-            'adr': adr,
-            'required_car_parking_spaces': required_car_parking_spaces,
-            'total_of_special_requests': total_of_special_requests
-        }
-        
-        # Create a DataFrame with the input
-        input_df = pl.DataFrame([input_data])
-        
-        # CREATE THE MISSING FEATURE: same_room_type
-        # This is the line that was missing!
-        input_df = input_df.with_columns(
-            pl.when(pl.col("reserved_room_type") == pl.col("assigned_room_type"))
-            .then(pl.lit(1))
-            .otherwise(pl.lit(0))
-            .alias("same_room_type")
-        )
-        
-        # Apply label encoding for categorical variables
-        for col in input_df.columns:
-            if input_df[col].dtype == pl.Utf8:
-                if col in label_encoder:
-
-                    encoder = label_encoder[col]
-                    original_value = input_df[col].item()
-                    encoded_value = encoder.transform([original_value])[0]
-                    
-                    input_df = input_df.with_columns(
-                        pl.lit(encoded_value).alias(col)
-                    )
-        
+        # Submit button
+        submitted = st.form_submit_button("🔍 Predici Cancellazione", type="primary")
+        if submitted:
+            # Prepare input data
+            input_data = {
+                'hotel': hotel,
+                'lead_time': lead_time,
+                'arrival_date_week_number': arrival_date_week_number,
+                'stays_in_weekend_nights': stays_in_weekend_nights,
+                'stays_in_week_nights': stays_in_week_nights,
+                'adults': adults,
+                'children': children,
+                'babies': babies,
+                'meal': meal,
+                'country': country,
+                'market_segment': market_segment,
+                'distribution_channel': distribution_channel,
+                'is_repeated_guest': is_repeated_guest,
+                'previous_cancellations': previous_cancellations,
+                'previous_bookings_not_canceled': previous_bookings_not_canceled,
+                'reserved_room_type': reserved_room_type,
+                'assigned_room_type': assigned_room_type,
+                'booking_changes': booking_changes,
+                'deposit_type': deposit_type,
+                'days_in_waiting_list': days_in_waiting_list,
+                'customer_type': customer_type,
+                'adr': adr,
+                'required_car_parking_spaces': required_car_parking_spaces,
+                'total_of_special_requests': total_of_special_requests
+            }
+        
+            # base booking of the what-if analysis below the form
+            st.session_state["base_booking"] = input_data
+
+            # Create a DataFrame with the input, with the derived features (same_room_type) and the
+            # columns in the order of the trained model, like the batch scoring and the service
+            input_df = derive_features(pl.DataFrame([input_data]), metrics["feature_names"])
+        
+            # Apply label encoding for categorical variables and convert to the float32 matrix of the model
+            X_input = to_matrix(encode(input_df, label_encoder))
+        
+            # Make prediction
+            # repeated bookings are answered from the prediction cache
+            prediction_cache = get_prediction_cache()
+            with section("predict_proba"):
+                prediction_proba = prediction_cache.predict_proba(get_predictor(algorithm), X_input, model_version(algorithm=algorithm))[0]
+            prediction = int(prediction_proba[1] > 0.5)
+        
+            # Display results
+            st.markdown("---")
+            st.subheader(" Risultato Previsione")
+        
+            # Create columns for results
+            col1, col2 = st.columns(2)
+        
+            with col1:
+                if prediction == 1:
+                    st.error("🔴 **PRENOTAZIONE A RISCHIO CANCELLAZIONE**")
+                    st.warning("La prenotazione ha un'alta probabilità di cancellazione")
+                else:
+                    st.success("🟢 **PRENOTAZIONE PROBABILMENTE CONFERMATA**")
+                    st.info("La prenotazione ha una bassa probabilità di cancellazione")
+        
+            with col2:
+                st.metric(
+                    label="Probabilità di Cancellazione", 
+                    value=f"{prediction_proba[1]:.1%}",
+                )
+                st.metric(
+                    label="Probabilità di Conferma", 
+                    value=f"{prediction_proba[0]:.1%}"
+                )
+        
+            prob_df = pl.DataFrame({
+                'Esito': ['Non Cancellato', 'Cancellato'],
+                'Probabilità': [prediction_proba[0], prediction_proba[1]]
+            })
+        
+            prob_chart = alt.Chart(prob_df).mark_bar().encode(
+                x=alt.X('Probabilità:Q', scale=alt.Scale(domain=[0, 1]), axis=alt.Axis(format='%')),
+                color=alt.Color('Esito:N', 
+                               scale=alt.Scale(domain=['Non Cancellato', 'Cancellato'], 
+                                             range=["#2DD475", "#C41B3D"]))
+            ).properties(height=100)
+        
+            st.altair_chart(prob_chart, use_container_width=True)
+
+            cache_stats = prediction_cache.stats()
+            st.caption(f"Cache delle previsioni: {cache_stats['hits']} hit, {cache_stats['misses']} miss "
+                f"({cache_stats['hit_rate']:.0%}), {cache_stats['entries']}/{cache_stats['max_entries']} prenotazioni in memoria")
+        
+    what_if_panel()
+
+prediction_tool()
+
+checkpoint("previsione da file")
+"""
+### Previsione su un file di prenotazioni
 
-        # Convert to numpy array for prediction
-        X_input = input_df.to_numpy()
-        
-        # Make prediction
-        prediction = model.predict(X_input)[0]
-        prediction_proba = model.predict_proba(X_input)[0]
-        
-        # Display results
-        st.markdown("---")
-        st.subheader(" Risultato Previsione")
-        
-        # Create columns for results
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            if prediction == 1:
-                st.error("🔴 **PRENOTAZIONE A RISCHIO CANCELLAZIONE**")
-                st.warning("La prenotazione ha un'alta probabilità di cancellazione")
-            else:
-                st.success("🟢 **PRENOTAZIONE PROBABILMENTE CONFERMATA**")
-                st.info("La prenotazione ha una bassa probabilità di cancellazione")
-        
-        with col2:
-            st.metric(
-                label="Probabilità di Cancellazione", 
-                value=f"{prediction_proba[1]:.1%}",
-            )
-            st.metric(
-                label="Probabilità di Conferma", 
-                value=f"{prediction_proba[0]:.1%}"
-            )
-        
-        prob_df = pl.DataFrame({
-            'Esito': ['Non Cancellato', 'Cancellato'],
-            'Probabilità': [prediction_proba[0], prediction_proba[1]]
-        })
-        
-        prob_chart = alt.Chart(prob_df).mark_bar().encode(
-            x=alt.X('Probabilità:Q', scale=alt.Scale(domain=[0, 1]), axis=alt.Axis(format='%')),
-            color=alt.Color('Esito:N', 
-                           scale=alt.Scale(domain=['Non Cancellato', 'Cancellato'], 
-                                         range=["#2DD475", "#C41B3D"]))
-        ).properties(height=100)
-        
-        st.altair_chart(prob_chart, use_container_width=True)
-        
\ No newline at end of file
+Per prevedere molte prenotazioni insieme (ad esempio tutte quelle dei prossimi 30 giorni) si può caricare un file csv o parquet
+con le stesse colonne di hotel_bookings.csv. Il file viene elaborato a blocchi (stesse trasformazioni del training) e si scarica 
+un csv con la colonna cancel_probability; le prenotazioni con valori mancanti o categorie sconosciute al modello restano senza probabilità.
+"""
+@fragment("previsione da file")
+def batch_scoring():
+    uploaded = st.file_uploader("File di prenotazioni", type=["csv", "parquet"])
+    if uploaded is not None and st.button("Calcola le probabilità di cancellazione"):
+        # the upload is copied to a temporary file and read back one chunk at a time
+        suffix = os.path.splitext(uploaded.name)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            shutil.copyfileobj(uploaded, f)
+        out_path = f.name[:-len(suffix)] + "_scored.csv"
+        # the result of the session stays on disk: the previous one is removed at once,
+        # the last one when the session ends (ScoredFile)
+        previous = st.session_state.pop("scored_file", None)
+        if previous is not None:
+            previous.remove()
+        bar = st.progress(0.0, text="Previsione in corso...")
+        def progress(done, total):
+            bar.progress(min(done / max(total, 1), 1.0), text=f"{done} / {total} prenotazioni")
+        try:
+            with section("score_file"):
+                scored = score_file(f.name, out_path, get_model(algorithm)[0], label_encoder, metrics["feature_names"], progress)
+            st.session_state["scored_file"] = ScoredFile(out_path, os.path.splitext(uploaded.name)[0] + "_previsioni.csv")
+            st.success(f"{scored} prenotazioni elaborate")
+        except (pl.exceptions.PolarsError, ValueError, OSError) as e:
+            bar.empty()
+            st.error(f"Il file non può essere elaborato: {str(e).splitlines()[0]}")
+        finally:
+            os.remove(f.name)
+            # failed or interrupted by a rerun: no partial result on disk
+            if "scored_file" not in st.session_state:
+                remove_file(out_path)
+
+    scored_file = st.session_state.get("scored_file")
+    if scored_file is not None and os.path.exists(scored_file.path):
+        # st.download_button has no streaming: it reads the file and keeps a copy in memory while it is shown
+        with open(scored_file.path, "rb") as f:
+            st.download_button("Scarica le previsioni (csv)", f, file_name=scored_file.name, mime="text/csv")
+
+batch_scoring()
@@ -0,0 +1,404 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+
+# Benchmark for the ingest step (get_data eager vs lazy, and the warm
+# load from the memory mapped snapshot).
+# Every run happens in a fresh process, so the time is a cold start
+# and the peak memory (max RSS) is not polluted by previous runs.
+#
+# usage: uv run python benchmark.py --scale 10 --repeat 3
+#
+# With --forest it measures instead the prediction latency of the model:
+# sklearn predict_proba vs the flat arrays engine of forest.py, for batches of growing size.
+#
+# usage: uv run python benchmark.py --forest
+#
+# With --suite it runs the end-to-end suite: every stage of the app (ingest, maps,
+# preprocessing, training, single and batch predictions, headless render of the two
+# pages) on the bookings table scaled to 1x/10x/100x with a synthetic generator.
+# Each stage runs in a fresh process; the results are compared with the baseline
+# stored in benchmarks/ and a stage slower or heavier than the tolerance is a regression.
+#
+# usage: uv run python benchmark.py --suite --scales 1 10 100
+#        uv run python benchmark.py --suite --scales 1 --save-baseline
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(REPO, "benchmarks")
+SUITE_STAGES = ["get_data", "get_mapdata", "get_mapdata_countries", "preproc", "train_and_metric",
+    "predict_single", "predict_batch", "first_paint", "render_app", "render_model"]
+# stages that take minutes already at 1x: run only up to --heavy-max-scale
+HEAVY_STAGES = {"train_and_metric", "predict_batch"}
+# single booking predictions timed in the predict_single stage
+SINGLE_CALLS = 100
+# files of the model and of the map linked in the working directory of every scale
+SUITE_FILES = ["random_forest_model_0.pkl", "model_RF0_metrics.pkl", "encoders_RF0.json", "label_encoders_RF0.pkl",
+    "forest_RF0", "hist_gradient_boosting_model_0.pkl", "model_HGB0_metrics.pkl", "ne_10m_admin_0_countries.zip"]
+
+
+def scale_csv(path, scale, out_path):
+    #Write a copy of the csv repeated `scale` times (with a new index),
+    #to simulate larger booking exports.
+    data = pl.read_csv(path, infer_schema_length=0)
+    n = data.shape[0]
+    with open(out_path, "w") as out:
+        for i in range(scale):
+            chunk = data.with_columns(
+                (pl.col("index").cast(pl.Int64) + i * n).cast(pl.String).alias("index"))
+            chunk.write_csv(out, include_header=(i == 0))
+    return out_path
+
+
+def synth_csv(path, scale, out_path, seed = 42):
+    #Bookings table scaled `scale` times: the original rows followed by scale-1 synthetic copies.
+    #Every copy is a bootstrap resample of the rows (the joint distribution of the columns is kept)
+    #with lead_time and adr jittered, so the copies are not duplicates of the original bookings.
+    #The copies are written one at a time, the memory used does not depend on the scale.
+    data = pl.read_csv(path, infer_schema_length=0)
+    n = data.shape[0]
+    with open(out_path, "w") as out:
+        data.write_csv(out)
+        for i in range(1, scale):
+            rng = np.random.default_rng(seed + i)
+            chunk = data.sample(n, with_replacement=True, seed=seed + i).with_columns(
+                pl.Series("lead_noise", rng.integers(-7, 8, n)),
+                pl.Series("adr_factor", rng.normal(1.0, 0.05, n)),
+            )
+            lead_time = (pl.col("lead_time").cast(pl.Int64, strict=False) + pl.col("lead_noise")).clip(0)
+            adr = (pl.col("adr").cast(pl.Float64, strict=False) * pl.col("adr_factor")).round(2)
+            chunk = chunk.with_columns(
+                pl.int_range(i * n, (i + 1) * n).cast(pl.String).alias("index"),
+                # values that are not numbers (NA) are kept as they are
+                pl.coalesce(lead_time.cast(pl.String), pl.col("lead_time")).alias("lead_time"),
+                pl.coalesce(adr.cast(pl.String), pl.col("adr")).alias("adr"),
+            ).drop("lead_noise", "adr_factor")
+            chunk.write_csv(out, include_header=False)
+    return out_path
+
+
+def run_once(mode, path, cache_dir):
+    # executed in the child process
+    from preprocess import get_data, get_snapshot
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == "snapshot":
+        data = get_snapshot(path, cache_dir)
+    else:
+        data = get_data(lazy=(mode == "lazy"), path=path)
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "mode": mode,
+        "rows": data.shape[0],
+        "frame_mb": data.estimated_size("mb"),
+        "seconds": elapsed,
+        # ru_maxrss is in KB on linux
+        "peak_mb": rss_after / 1024,
+        "delta_peak_mb": (rss_after - rss_before) / 1024,
+    }))
+
+
+def measure(mode, path, cache_dir):
+    out = subprocess.run([sys.executable, __file__, "--child", mode, path, cache_dir],
+        capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def bench_forest(path, model_path = "random_forest_model_0.pkl", sizes = (1, 16, 256, 4096), repeat = 20):
+    #Median latency of predict_proba for every batch size, and check that the probabilities are identical.
+    import joblib
+    from encoders import to_matrix
+    from forest import FlatForest
+    from preprocess import get_snapshot
+    from trainmodel import preproc
+
+    df, _ = preproc(get_snapshot(path))
+    X = to_matrix(df.drop("is_canceled"))
+    model = joblib.load(model_path)
+    start = time.perf_counter()
+    flat = FlatForest.from_model(model)
+    print(f"compile: {time.perf_counter() - start:.2f}s, {flat.nbytes() / 2**20:.0f} MB")
+
+    engines = {"sklearn (n_jobs=1)": model.set_params(n_jobs=1).predict_proba, "flat": flat.predict_proba}
+    results = []
+    for size in sizes:
+        batches = [X[i * size:(i + 1) * size] for i in range(min(repeat, len(X) // size))]
+        row = {"rows": size}
+        for name, predict in engines.items():
+            times = []
+            for batch in batches:
+                start = time.perf_counter()
+                predict(batch)
+                times.append(time.perf_counter() - start)
+            row[f"{name} ms"] = float(np.median(times)) * 1000
+        row["speedup"] = row["sklearn (n_jobs=1) ms"] / row["flat ms"]
+        row["identical"] = all(np.array_equal(model.predict_proba(b), flat.predict_proba(b)) for b in batches)
+        results.append(row)
+    return pl.DataFrame(results)
+
+
+def reset_peak():
+    #Reset the peak RSS of the process (linux), so the peak of a stage does not include its setup.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def memory_mb():
+    #Current and peak RSS of the process; without /proc only the peak of the whole process is known.
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+def prepare_stage(stage):
+    #Callable of the measured stage and the number of calls it makes. Its inputs are prepared
+    #here (not measured); the snapshot and the world layer are already on disk, the caches of
+    #the process are empty.
+    from encoders import to_matrix
+    from preprocess import PROJECTION_DETAIL, get_data, get_mapdata, get_snapshot, get_world, load_model
+    import trainmodel
+
+    if stage == "get_data":
+        return lambda: get_data(), 1
+    if stage in ("get_mapdata", "get_mapdata_countries"):
+        get_world(PROJECTION_DETAIL["equalEarth"])
+        if stage == "get_mapdata":
+            return lambda: get_mapdata(), 1
+        # bookings aggregated by country inside get_mapdata
+        data = get_snapshot()
+        return lambda: get_mapdata(data), 1
+    if stage == "preproc":
+        data = get_snapshot()
+        return lambda: trainmodel.preproc(data), 1
+    df, label_encoders = trainmodel.preproc(get_snapshot())
+    if stage == "train_and_metric":
+        return lambda: trainmodel.train_and_metric(df, categorical=list(label_encoders)), 1
+    X = to_matrix(df.drop("is_canceled"))
+    del df
+    if stage == "predict_single":
+        # the flat forest of the form of the Modello page
+        model = load_model(engine="flat")[0]
+        return lambda: [model.predict_proba(X[i:i + 1]) for i in range(SINGLE_CALLS)], SINGLE_CALLS
+    if stage == "predict_batch":
+        # the sklearn model of the batch scoring, on all the bookings
+        model = load_model()[0]
+        return lambda: model.predict_proba(X), 1
+    raise ValueError(f"unknown stage {stage}")
+
+def prepare_first_paint():
+    #Time from the start of the first run of home.py to the first element sent to the browser,
+    #the wait of the first visitor after a deploy (streamlit is already imported, like in the server).
+    from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+    from streamlit.testing.v1 import AppTest
+    first = []
+    enqueue = ForwardMsgQueue.enqueue
+    def record(self, msg):
+        if not first and msg.WhichOneof("type") == "delta":
+            first.append(time.perf_counter())
+        enqueue(self, msg)
+    ForwardMsgQueue.enqueue = record
+    def render():
+        start = time.perf_counter()
+        AppTest.from_file(os.path.join(REPO, "home.py"), default_timeout=3600).run()
+        return first[0] - start
+    return render, 1
+
+def prepare_render(stage):
+    # only streamlit is imported before: the page imports and loads everything like a new server
+    from streamlit.testing.v1 import AppTest
+    if stage == "first_paint":
+        return prepare_first_paint()
+    page = os.path.join(REPO, {"render_app": "app.py", "render_model": "app_model.py"}[stage])
+    def render():
+        at = AppTest.from_file(page, default_timeout=3600).run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+    return render, 1
+
+def check_chunks(path = "hotel_bookings.csv"):
+    #The batch scoring reads chunks of exactly CHUNK_ROWS bookings (only the last one is shorter):
+    #checked on the first two chunks of the scaled csv.
+    from scoring import CHUNK_ROWS, count_rows, iter_chunks
+    if count_rows(path) <= 2 * CHUNK_ROWS:
+        return
+    sizes = [len(chunk) for chunk, _ in zip(iter_chunks(path), range(2))]
+    if sizes != [CHUNK_ROWS, CHUNK_ROWS]:
+        raise RuntimeError(f"chunks of {sizes} rows instead of {CHUNK_ROWS}")
+
+def run_stage(stage):
+    # executed in the child process, in the working directory of the scale
+    sys.path.insert(0, REPO)
+    if stage == "warmup":
+        # snapshot of the scaled dataset, shared by the stages
+        from preprocess import get_snapshot
+        get_snapshot()
+        check_chunks()
+        return
+    render = stage.startswith("render_") or stage == "first_paint"
+    run, calls = prepare_render(stage) if render else prepare_stage(stage)
+    reset_peak()
+    rss_before, _ = memory_mb()
+    start = time.perf_counter()
+    # a stage can return its own measure (first_paint), otherwise the wall time is used
+    elapsed = run()
+    if not isinstance(elapsed, float):
+        elapsed = time.perf_counter() - start
+    _, peak = memory_mb()
+    print(json.dumps({"stage": stage, "seconds": elapsed, "ms_per_call": elapsed / calls * 1000,
+        "peak_mb": peak, "delta_peak_mb": peak - rss_before}))
+
+def measure_stage(stage, work):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--stage", stage],
+        cwd=work, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"stage {stage} failed:\n{out.stderr[-2000:]}")
+    if stage != "warmup":
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+def prepare_workdir(csv, scale, work, model_dir):
+    #Working directory of a scale: the synthetic hotel_bookings.csv and links to the model and map files.
+    synth_csv(csv, scale, os.path.join(work, "hotel_bookings.csv"))
+    for name in SUITE_FILES:
+        source = os.path.abspath(os.path.join(model_dir, name))
+        if os.path.exists(source):
+            os.symlink(source, os.path.join(work, name))
+    measure_stage("warmup", work)
+
+def run_suite(csv, scales = (1, 10, 100), stages = SUITE_STAGES, heavy_max_scale = 10, repeat = 1,
+        model_dir = ".") -> pl.DataFrame:
+    #Best time (and its peak memory) of every stage at every scale.
+    rows = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as work:
+            prepare_workdir(csv, scale, work, model_dir)
+            n_rows = pl.scan_csv(os.path.join(work, "hotel_bookings.csv")).select(pl.len()).collect().item()
+            for stage in stages:
+                if stage in HEAVY_STAGES and scale > heavy_max_scale:
+                    print(f"x{scale} {stage}: skipped (--heavy-max-scale {heavy_max_scale})", flush=True)
+                    continue
+                best = min((measure_stage(stage, work) for _ in range(repeat)), key=lambda r: r["seconds"])
+                print(f"x{scale} {stage}: {best['seconds']:.2f}s, peak {best['peak_mb']:.0f} MB", flush=True)
+                rows.append({"scale": scale, "rows": n_rows, **best})
+    return pl.DataFrame(rows)
+
+def suite_meta(csv) -> dict:
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"), "csv": os.path.abspath(csv),
+        "python": platform.python_version(), "polars": pl.__version__, "machine": platform.machine(),
+        "cpus": os.cpu_count()}
+
+def save_results(results, meta, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results.to_dicts()}, f, indent=2)
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return pl.DataFrame(json.load(f)["results"])
+
+def compare(results, baseline, tolerance = 0.2) -> pl.DataFrame:
+    #Ratio current/baseline of time and peak memory of every stage and scale.
+    #Status: regression if either grows more than the tolerance, improved if the time drops by more.
+    if baseline is None:
+        return results.with_columns(pl.lit("new").alias("status"))
+    base = baseline.select("stage", "scale", pl.col("seconds").alias("base_seconds"),
+        pl.col("peak_mb").alias("base_peak_mb"))
+    report = results.join(base, on=["stage", "scale"], how="left").with_columns(
+        (pl.col("seconds") / pl.col("base_seconds")).alias("time_ratio"),
+        (pl.col("peak_mb") / pl.col("base_peak_mb")).alias("memory_ratio"),
+    )
+    return report.with_columns(
+        pl.when(pl.col("base_seconds").is_null()).then(pl.lit("new"))
+        .when((pl.col("time_ratio") > 1 + tolerance) | (pl.col("memory_ratio") > 1 + tolerance)).then(pl.lit("regression"))
+        .when(pl.col("time_ratio") < 1 - tolerance).then(pl.lit("improved"))
+        .otherwise(pl.lit("ok")).alias("status")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time and peak memory of get_data")
+    parser.add_argument("--csv", default="hotel_bookings.csv")
+    parser.add_argument("--scale", type=int, default=10, help="how many times the csv is replicated")
+    parser.add_argument("--repeat", type=int, help="runs of every measure (default 3, 1 for the suite)")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument("--forest", action="store_true", help="benchmark the prediction engines instead of get_data")
+    parser.add_argument("--suite", action="store_true", help="end-to-end suite of all the stages, compared with the baseline")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="sizes of the synthetic dataset (suite)")
+    parser.add_argument("--stages", nargs="+", choices=SUITE_STAGES, default=SUITE_STAGES)
+    parser.add_argument("--heavy-max-scale", type=int, default=10, help="largest scale of training and batch prediction")
+    parser.add_argument("--model-dir", default=".", help="directory of the model artifacts and of the shapefile")
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.forest:
+        print(bench_forest(args.csv))
+        return
+
+    if args.stage:
+        run_stage(args.stage)
+        return
+
+    if args.suite:
+        results = run_suite(args.csv, args.scales, args.stages, args.heavy_max_scale, args.repeat or 1, args.model_dir)
+        meta = suite_meta(args.csv)
+        save_results(results, meta, os.path.join(BENCH_DIR, "latest.json"))
+        report = compare(results, load_baseline(args.baseline), args.tolerance)
+        report.write_csv(os.path.join(BENCH_DIR, "report.csv"))
+        columns = ["scale", "stage", "seconds", "ms_per_call", "peak_mb", "time_ratio", "memory_ratio", "status"]
+        with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=160, float_precision=3):
+            print(report.select([c for c in columns if c in report.columns]))
+        if args.save_baseline:
+            save_results(results, meta, args.baseline)
+            print(f"baseline saved in {args.baseline}")
+        # non zero exit status for the CI
+        sys.exit(1 if (report["status"] == "regression").any() else 0)
+
+    if args.child:
+        run_once(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.csv
+        if args.scale > 1:
+            path = scale_csv(args.csv, args.scale, os.path.join(tmp, f"bookings_x{args.scale}.csv"))
+        # build the snapshot once, the measured runs are warm starts
+        measure("snapshot", path, tmp)
+        results = []
+        for mode in ["eager", "lazy", "snapshot"]:
+            for _ in range(args.repeat or 3):
+                results.append(measure(mode, path, tmp))
+
+    report = pl.DataFrame(results).group_by("mode", maintain_order=True).agg(
+        pl.col("rows").first(),
+        pl.col("frame_mb").first(),
+        pl.col("seconds").min().alias("best_seconds"),
+        pl.col("seconds").mean().alias("mean_seconds"),
+        pl.col("peak_mb").max(),
+        pl.col("delta_peak_mb").max(),
+    )
+    print(f"get_data on {args.csv} x{args.scale}")
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import functools
+import inspect
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Bounded LRU cache of the predictions of the model, shared by all the sessions
+# (and threads) of the app. The key is the version of the model plus the bytes of the
+# encoded float32 feature vector, so the same booking submitted again is answered
+# without running the forest, and a new model never reuses old predictions.
+
+
+class PredictionCache:
+    def __init__(self, max_entries = 4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def predict_proba(self, model, X, version) -> np.ndarray:
+        #model.predict_proba(X) with the rows already seen taken from the cache;
+        #the missing rows are scored together in one call.
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        keys = [(version, row.tobytes()) for row in X]
+        cached = [self.get(key) for key in keys]
+        missing = [i for i, value in enumerate(cached) if value is None]
+        if missing:
+            proba = model.predict_proba(X[missing])
+            for i, p in zip(missing, proba):
+                cached[i] = p
+                self.put(keys[i], p)
+        return np.array(cached)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Cache of the loaders of the app (dataset, cube, map layers, map html, models, what-if curves):
+# one LRU for all of them with a global memory budget (HOTEL_CACHE_MB, default 2048 MB).
+# Every entry is stored with its approximate size; when the total goes over the budget the
+# least recently used entries are evicted, whatever function they belong to. Unlike
+# st.cache_resource the size, the hits and the evictions are visible (admin page).
+
+BUDGET_ENV_VAR = "HOTEL_CACHE_MB"
+
+
+class ByteCounter:
+    # file-like object that only counts the bytes written by pickle
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, data):
+        self.nbytes += memoryview(data).nbytes
+
+
+def sizeof(obj, seen = None) -> int:
+    #Approximate bytes held by obj: arrays and data frames by their buffers, containers and plain
+    #objects by their content, extension objects (e.g. the Cython trees of sklearn) by the state
+    #they expose for pickling (views of their node arrays), only the others by their pickle size.
+    #Memory mapped numpy arrays (the flat forest) count 0, their pages belong to the file and the
+    #OS can drop them. Polars frames are charged their estimated_size also when they are memory
+    #mapped (the Arrow snapshot of get_all): polars does not tell, so the size is an upper bound.
+    # id -> object: the objects are kept alive, so the id of a temporary state is not reused
+    seen = {} if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen[id(obj)] = obj
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.nbytes
+    if hasattr(obj, "estimated_size"):
+        # polars DataFrame and Series
+        return int(obj.estimated_size())
+    if hasattr(obj, "memory_usage"):
+        # pandas and geopandas: the geometries count 16 bytes per coordinate
+        size = int(np.sum(obj.memory_usage(deep=True)))
+        geometry = getattr(obj, "geometry", None)
+        if geometry is not None:
+            import shapely
+            size += int(shapely.get_num_coordinates(np.asarray(geometry.values)).sum()) * 16
+        return size
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(sizeof(item, seen) for item in obj)
+    if hasattr(obj, "__dict__"):
+        return sys.getsizeof(obj) + sizeof(vars(obj), seen)
+    state = obj.__getstate__()
+    if isinstance(state, (dict, tuple)):
+        return sys.getsizeof(obj) + sizeof(state, seen)
+    counter = ByteCounter()
+    try:
+        pickle.dump(obj, counter, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return sys.getsizeof(obj)
+    return counter.nbytes
+
+
+class MemoryCache:
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        # (function, key) -> (value, nbytes)
+        self.entries = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+        # one lock per key being computed: concurrent callers (sessions, warm up) compute it once
+        self.computing = {}
+        # function -> max_entries and counters
+        self.functions = {}
+
+    def register(self, name, max_entries = None):
+        with self.lock:
+            counters = self.functions.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0, "oversize": 0})
+            counters["max_entries"] = max_entries
+
+    def lookup(self, full_key):
+        # called with self.lock held
+        entry = self.entries.get(full_key)
+        if entry is not None:
+            self.entries.move_to_end(full_key)
+            self.functions[full_key[0]]["hits"] += 1
+        return entry
+
+    def get_or_compute(self, name, key, compute):
+        full_key = (name, key)
+        with self.lock:
+            entry = self.lookup(full_key)
+            if entry is not None:
+                return entry[0]
+            key_lock = self.computing.setdefault(full_key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                # computed by another thread while this one was waiting
+                entry = self.lookup(full_key)
+                if entry is not None:
+                    return entry[0]
+                self.functions[name]["misses"] += 1
+            try:
+                value = compute()
+                nbytes = sizeof(value)
+                with self.lock:
+                    self.store(full_key, value, nbytes)
+            finally:
+                with self.lock:
+                    self.computing.pop(full_key, None)
+        return value
+
+    def store(self, full_key, value, nbytes):
+        # called with self.lock held
+        name = full_key[0]
+        counters = self.functions[name]
+        if nbytes > self.budget:
+            # returned to the caller but not kept: it would evict everything else
+            counters["oversize"] += 1
+            return
+        self.entries[full_key] = (value, nbytes)
+        self.used += nbytes
+        if counters["max_entries"] is not None:
+            own = [k for k in self.entries if k[0] == name]
+            for old in own[:max(0, len(own) - counters["max_entries"])]:
+                self.evict(old)
+        for old in list(self.entries):
+            if self.used <= self.budget:
+                break
+            if old != full_key:
+                self.evict(old)
+
+    def evict(self, full_key):
+        _, nbytes = self.entries.pop(full_key)
+        self.used -= nbytes
+        self.functions[full_key[0]]["evictions"] += 1
+
+    def clear(self, name = None):
+        #Remove the entries of the function name, or all of them (not counted as evictions).
+        with self.lock:
+            for full_key in [k for k in self.entries if name is None or k[0] == name]:
+                _, nbytes = self.entries.pop(full_key)
+                self.used -= nbytes
+
+    def stats(self) -> dict:
+        with self.lock:
+            functions = []
+            for name, counters in self.functions.items():
+                sizes = [nbytes for (fn, _), (_, nbytes) in self.entries.items() if fn == name]
+                lookups = counters["hits"] + counters["misses"]
+                functions.append({"function": name, "entries": len(sizes), "bytes": sum(sizes), **counters,
+                    "hit_rate": counters["hits"] / lookups if lookups else 0.0})
+            hits = sum(f["hits"] for f in functions)
+            lookups = hits + sum(f["misses"] for f in functions)
+            return {
+                "budget": self.budget,
+                "used": self.used,
+                "entries": len(self.entries),
+                "hits": hits,
+                "evictions": sum(f["evictions"] for f in functions),
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "functions": functions,
+                # least recently used first
+                "keys": [{"function": fn, "key": repr(key), "bytes": nbytes}
+                    for (fn, key), (_, nbytes) in self.entries.items()],
+            }
+
+
+MEMORY_CACHE = MemoryCache(int(float(os.environ.get(BUDGET_ENV_VAR, 2048)) * 2**20))
+
+def cached(max_entries = None, cache = None):
+    #Decorator: results kept in the memory cache, keyed by the arguments (with the defaults applied,
+    #so positional and keyword calls share the entry); arguments starting with _ are not part of the key.
+    def decorator(func):
+        store = cache or MEMORY_CACHE
+        name = f"{func.__module__}.{func.__qualname__}"
+        signature = inspect.signature(func)
+        store.register(name, max_entries)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = tuple((arg, value) for arg, value in bound.arguments.items() if not arg.startswith("_"))
+            return store.get_or_compute(name, key, lambda: func(*args, **kwargs))
+        functools.update_wrapper(wrapper, func)
+        wrapper.clear = lambda: store.clear(name)
+        return wrapper
+    return decorator
@@ -0,0 +1,55 @@
+import json
+import os
+
+import joblib
+import numpy as np
+import polars as pl
+
+# Dictionary encoder of the categorical features of the model.
+# Every column is encoded with the physical codes of a pl.Enum built on its sorted
+# categories, so the codes are the same of sklearn's LabelEncoder (the previous
+# label_encoders_RF0.pkl) and the encoding is a single cast, without python loops.
+# The artifact is a small json: {column: [categories]}.
+
+# categories used for values never seen in training (countries outside the top list)
+FALLBACK = {"country": "Other"}
+
+
+def fit_encoders(df, columns) -> dict:
+    #Sorted categories of every column (same order of LabelEncoder.classes_).
+    return {col: sorted(df[col].cast(pl.String).unique().drop_nulls().to_list()) for col in columns}
+
+def encode(df, encoders, fallback = FALLBACK) -> pl.DataFrame:
+    #Replace the categorical columns with their codes (UInt32 physical codes of the Enum).
+    #Unseen values go to the fallback category of the column; a column without
+    #fallback raises ValueError instead of getting a wrong code.
+    exprs = []
+    for col, categories in encoders.items():
+        if col not in df.columns:
+            continue
+        values = pl.col(col).cast(pl.String)
+        if col in fallback:
+            values = pl.when(values.is_in(categories)).then(values).otherwise(pl.lit(fallback[col]))
+        else:
+            unseen = df[col].cast(pl.String).filter(~df[col].cast(pl.String).is_in(categories)).unique().to_list()
+            if unseen:
+                raise ValueError(f"unseen categories in {col}: {unseen}")
+        exprs.append(values.cast(pl.Enum(categories)).to_physical().alias(col))
+    return df.with_columns(exprs)
+
+def to_matrix(df) -> np.ndarray:
+    #Float32, C contiguous feature matrix: the layout used internally by the sklearn forests,
+    #so fit and predict do not copy it again.
+    return df.cast(pl.Float32).to_numpy(order="c")
+
+def save_encoders(encoders, path):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(encoders, f)
+    os.replace(f"{path}.tmp", path)
+
+def load_encoders(path) -> dict:
+    #Categories of every column from the json artifact, or from a legacy pickle of LabelEncoders.
+    if path.endswith(".pkl"):
+        return {col: [str(c) for c in encoder.classes_] for col, encoder in joblib.load(path).items()}
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,142 @@
+import json
+import os
+
+import numpy as np
+
+# Inference engine for the trained RandomForestClassifier.
+# The trees of the forest are compiled in a few contiguous arrays: for the split nodes
+# of all the trees the feature, the threshold and the two children; for the leaves the
+# class probabilities. A child is a split node if >= 0 and the leaf ~child otherwise.
+# The traversal moves all the (row, tree) pairs one level per step with numpy
+# operations, so a prediction costs a few array operations per level instead of a
+# python call per tree: a single row or a small batch (the form of the Modello page,
+# the micro-batches of the service) is several times faster than model.predict_proba.
+# On large batches the compiled loop of sklearn is faster, so the batch scoring keeps the sklearn model.
+#
+# The probabilities are the same of model.predict_proba: thresholds are rounded down
+# to float32 (x <= t has the same result for float32 x), missing values follow
+# missing_go_to_left, the leaves are normalized like DecisionTreeClassifier and the
+# trees are summed in the same order.
+
+# rows traversed together, bounds the (rows x trees) arrays
+CHUNK_ROWS = 4096
+
+# arrays of the artifact: saved as one .npy file each (memory mapped when loaded)
+# or together in a compressed forest.npz
+ARRAYS = ["feature", "threshold", "children", "missing_right", "value", "roots"]
+
+
+class FlatForest:
+    def __init__(self, feature, threshold, children, missing_right, value, roots, classes):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.missing_right = missing_right
+        self.value = value
+        self.roots = roots
+        self.classes_ = classes
+
+    @classmethod
+    def from_model(cls, model):
+        #Compile a fitted RandomForestClassifier.
+        feature, threshold, children, missing_right, value, roots = [], [], [], [], [], []
+        n_split = n_leaf = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            leaf = tree.children_left == -1
+            split = ~leaf
+            # global ids: split nodes count from 0, leaves are stored as ~leaf_id
+            ids = np.where(leaf, ~(np.cumsum(leaf) - 1 + n_leaf), np.cumsum(split) - 1 + n_split)
+            feature.append(tree.feature[split].astype(np.int32))
+            # largest float32 <= threshold
+            t = tree.threshold[split]
+            t32 = t.astype(np.float32)
+            above = t32.astype(np.float64) > t
+            t32[above] = np.nextafter(t32[above], np.float32(-np.inf))
+            threshold.append(t32)
+            # children[2 * node] is the left child, children[2 * node + 1] the right one
+            children.append(np.stack([ids[tree.children_left[split]], ids[tree.children_right[split]]],
+                axis=1).ravel().astype(np.int32))
+            missing_right.append(~tree.missing_go_to_left[split].astype(bool))
+            # class probabilities of the leaves, normalized like DecisionTreeClassifier.predict_proba
+            proba = tree.value[leaf, 0, :]
+            normalizer = proba.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value.append(proba / normalizer)
+            roots.append(ids[0])
+            n_split += split.sum()
+            n_leaf += leaf.sum()
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(children),
+            np.concatenate(missing_right), np.concatenate(value), np.array(roots, dtype=np.int32),
+            model.classes_)
+
+    def apply(self, X) -> np.ndarray:
+        #Leaf reached by every row in every tree (rows x trees).
+        n_rows, n_features = X.shape
+        flat = X.ravel()
+        has_nan = np.isnan(flat).any()
+        node = np.tile(self.roots, n_rows)
+        offset = np.repeat(np.arange(n_rows, dtype=np.int64) * n_features, len(self.roots))
+        # pairs still on a split node
+        active = np.flatnonzero(node >= 0)
+        while active.size:
+            current = node[active]
+            x = flat[offset[active] + self.feature[current]]
+            go_right = x > self.threshold[current]
+            if has_nan:
+                go_right |= np.isnan(x) & self.missing_right[current]
+            following = self.children[2 * current + go_right]
+            node[active] = following
+            active = active[following >= 0]
+        return (~node).reshape(n_rows, len(self.roots))
+
+    def predict_proba(self, X) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.zeros((X.shape[0], self.value.shape[1]))
+        for start in range(0, X.shape[0], CHUNK_ROWS):
+            leaves = self.apply(X[start:start + CHUNK_ROWS])
+            chunk = out[start:start + CHUNK_ROWS]
+            # tree by tree, the same order of the sum in RandomForestClassifier.predict_proba
+            for t in range(leaves.shape[1]):
+                chunk += self.value[leaves[:, t]]
+        out /= len(self.roots)
+        return out
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def save(self, path, compress = False, precision = "float64"):
+        #Write the forest in the directory path. precision "float32"/"float16" stores the leaf
+        #probabilities with less bits (exact for pure leaves, the common case of fully grown trees,
+        #rounded otherwise); compress writes a compressed npz that can not be memory mapped.
+        os.makedirs(path, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays["value"] = arrays["value"].astype(precision)
+        for name in os.listdir(path):
+            # files of a previous save in the other format
+            if name.endswith((".npy", ".npz")):
+                os.remove(os.path.join(path, name))
+        if compress:
+            np.savez_compressed(os.path.join(path, "forest.npz"), **arrays)
+        else:
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f"{name}.npy"), array)
+        with open(os.path.join(path, "forest.json"), "w") as f:
+            json.dump({"classes": self.classes_.tolist(), "compress": compress, "precision": precision}, f)
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        #Read a forest written by save. The .npy arrays are memory mapped: loading is immediate
+        #and the pages of the nodes are read from disk the first time a prediction reaches them.
+        with open(os.path.join(path, "forest.json")) as f:
+            meta = json.load(f)
+        if meta["compress"]:
+            with np.load(os.path.join(path, "forest.npz")) as data:
+                arrays = {name: data[name] for name in ARRAYS}
+        else:
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                for name in ARRAYS}
+        return cls(classes=np.array(meta["classes"]), **arrays)
@@ -1,6 +1,20 @@
+import os
+
 import streamlit as st
+import profiler
+from preprocess import start_warmup
+
+# data, maps and model loaded in background from the first run of the server (HOTEL_WARMUP=0 disables it)
+start_warmup()
 
 vis = st.Page("app.py", title="Esplorazione Dati")
 model = st.Page("app_model.py", title="Modello")
-pag = st.navigation([vis, model])
-pag.run()
\ No newline at end of file
+pages = [vis, model]
+# memory and hit rate of the server caches, for the maintainers only (HOTEL_ADMIN=1)
+if os.environ.get("HOTEL_ADMIN", "") not in ("", "0"):
+    pages.append(st.Page("app_admin.py", title="Cache"))
+pag = st.navigation(pages)
+# opt-in timing of the sections of the page (HOTEL_PROFILE=1 or ?profile=1)
+profiler.start_run(pag.title)
+pag.run()
+profiler.panel()
@@ -0,0 +1,78 @@
+import argparse
+import hashlib
+import json
+import os
+
+import polars as pl
+
+from aggregates import build_cube, merge_counts
+from preprocess import (CACHE_DIR, NULL_VALUES, clean, get_snapshot, manifest_path,
+    read_manifest, remove_stale, save_ipc, snapshot_key)
+
+# Incremental ingestion of new booking batches: the delta file is cleaned on its own
+# and merged in the cached dataset, without reprocessing the whole history.
+#
+# usage: uv run python ingest.py new_bookings.csv
+
+
+def append_bookings(delta_path, path = "hotel_bookings.csv", cache_dir = CACHE_DIR) -> pl.DataFrame:
+    #Merge a file of new or updated bookings (same columns of hotel_bookings.csv) into the cached dataset.
+    #Only the delta goes through the cleaning rules of get_data; bookings with an index already
+    #present replace the old ones. The cube (and so the country aggregates of the maps) is updated
+    #subtracting the counts of the replaced bookings and adding the ones of the delta.
+    data = get_snapshot(path, cache_dir)
+    source = snapshot_key(path)
+    manifest = read_manifest(path, cache_dir)
+    if manifest is not None and manifest["source"] == source:
+        version, deltas = manifest["version"], manifest["deltas"]
+        cube = pl.read_ipc(os.path.join(cache_dir, manifest["cube"]))
+    else:
+        version, deltas = source, []
+        cube = build_cube(data)
+
+    # small file: infer the types on all the rows
+    raw = pl.read_csv(delta_path, null_values=NULL_VALUES, infer_schema_length=None)
+    delta = clean(raw.lazy()).collect()
+    # an updated booking replaces the old one even if the new row is then dropped by the cleaning
+    updated = pl.col("index").is_in(raw["index"].cast(pl.UInt32))
+    replaced = data.filter(updated)
+    merged = pl.concat([data.filter(~updated), delta]).with_columns(pl.col("country").cast(pl.Categorical))
+    cube = merge_counts(cube, build_cube(replaced), build_cube(delta))
+
+    # new version: hash of the previous one and of the delta file
+    with open(delta_path, "rb") as f:
+        delta_hash = hashlib.file_digest(f, "sha256").hexdigest()[:16]
+    version = hashlib.sha256((version + delta_hash).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    snapshot, cube_file = f"{stem}_{version}.arrow", f"{stem}_{version}.cube.arrow"
+    save_ipc(merged, os.path.join(cache_dir, snapshot))
+    save_ipc(cube, os.path.join(cache_dir, cube_file))
+
+    stat = os.stat(path)
+    target = manifest_path(path, cache_dir)
+    with open(f"{target}.{os.getpid()}.tmp", "w") as f:
+        json.dump({
+            "source": source,
+            "version": version,
+            "csv": [stat.st_size, stat.st_mtime_ns],
+            "snapshot": snapshot,
+            "cube": cube_file,
+            "deltas": deltas + [delta_hash],
+        }, f, indent=2)
+    os.replace(f"{target}.{os.getpid()}.tmp", target)
+    remove_stale(cache_dir, f"{stem}_*.arrow", [snapshot, cube_file])
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Append new or updated bookings to the cached dataset")
+    parser.add_argument("delta", nargs="+", help="csv files with the same columns of hotel_bookings.csv")
+    parser.add_argument("--csv", default="hotel_bookings.csv")
+    args = parser.parse_args()
+    for delta in args.delta:
+        data = append_bookings(delta, args.csv)
+        print(f"{delta}: dataset now has {data.shape[0]} bookings")
+
+
+if __name__ == "__main__":
+    main()
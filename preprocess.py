@@ -1,30 +1,262 @@
+from __future__ import annotations
+
+import glob
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import threading
 import polars as pl
-import geopandas as gpd
 import streamlit as st
 import altair as alt
 import joblib
-from scipy.stats import chi2_contingency
+from encoders import load_encoders
+from forest import FlatForest
+from cache import PredictionCache, cached
+from profiler import profiled, section
+from aggregates import build_cube, build_series, cube_rate, median_by, smooth
 
-@st.cache_resource
-def get_all():
-    data = get_data()
-    world = get_mapdata()
-    joined = get_mapdata(data)
-    return data, world, joined
+# geopandas/shapely (maps) and scipy (chi-square) are imported by the functions that use them:
+# they are the slowest imports of the page and the first elements are drawn without them.
+
+# folder for the snapshots of the cleaned dataset
+CACHE_DIR = ".cache"
+NULL_VALUES = ["Undefined","NA"]
+
+# The cached loaders take the version of the dataset (dataset_version()), so a batch
+# appended with ingest.py is picked up by the running servers at the next rerun.
+# They share the memory budget of cache.MEMORY_CACHE (HOTEL_CACHE_MB): the least
+# recently used entries are evicted first, hits and sizes are on the admin page.
+
+@profiled()
+@cached(max_entries=2)
+def get_all(version = None):
+    data = get_snapshot()
+    return data
+
+@profiled()
+@cached(max_entries=4)
+def get_maps(projection = "equalEarth", version = None):
+    #World layer and bookings by country (from the cube), at the level of detail of the projection
+    countries = cube_rate(get_cube(version)[0], "country").rename({"cancel_rate": "rate_cancelled"})
+    world = get_mapdata(projection=projection)
+    joined = get_mapdata(countries, projection)
+    return world, joined
+
+@profiled()
+@cached(max_entries=2)
+def get_cube(version = None):
+    #Aggregate cube and precomputed series of the EDA page, built once per version of the dataset.
+    #When batches have been appended the cube kept up to date by ingest.py is loaded instead.
+    data = get_all(version)
+    manifest = read_manifest()
+    if manifest is not None and manifest["version"] == version:
+        cube = pl.read_ipc(os.path.join(CACHE_DIR, manifest["cube"]))
+    else:
+        cube = build_cube(data)
+    return cube, build_series(data)
+
+# bandwidth of the smoothing of the adr chart
+LOESS_BANDWIDTH = 0.04
+
+@profiled()
+@cached(max_entries=4)
+def get_smoothed_adr(bandwidth = LOESS_BANDWIDTH, version = None) -> pl.DataFrame:
+    #Daily median adr per hotel smoothed with loess, computed once per bandwidth
+    daily = median_by(get_all(version), "adr", "arrival_date", "hotel")
+    return smooth(daily, "arrival_date", "adr", "hotel", bandwidth)
+
+# Artifacts of the model (written by trainmodel.py). The Modello page loads them separately:
+# metrics and encoders at once (small files), the forest only at the first prediction.
+MODEL_FILE = "random_forest_model_0.pkl"
+METRICS_FILE = "model_RF0_metrics.pkl"
+ENCODERS_FILE = "encoders_RF0.json"
+FOREST_DIR = "forest_RF0"
+
+# Algorithms that trainmodel.py can train (--algorithm), with the files of their model and metrics.
+# The encoders are shared, the flat forest exists only for the random forest.
+ALGORITHMS = {
+    "rf": {"name": "Random Forest", "model": MODEL_FILE, "metrics": METRICS_FILE},
+    "hgb": {"name": "Histogram Gradient Boosting", "model": "hist_gradient_boosting_model_0.pkl",
+        "metrics": "model_HGB0_metrics.pkl"},
+}
+
+@profiled()
+@cached()
+def get_metrics(algorithm = "rf"):
+    return joblib.load(ALGORITHMS[algorithm]["metrics"])
+
+@profiled()
+@cached()
+def get_encoders():
+    return load_encoders(encoders_path())
+
+@profiled()
+@cached()
+def get_forest():
+    # model as flat arrays, memory mapped, for the single booking predictions
+    return load_forest()
+
+@profiled()
+@cached()
+def get_model(algorithm = "rf"):
+    return load_model(algorithm=algorithm)
 
 @st.cache_resource
-def get_model():
-# Load pre-trained model, metrics and label encoder from file
-    model = joblib.load("random_forest_model_0.pkl")
-    metrics = joblib.load("model_RF0_metrics.pkl")
-    label_encoder = joblib.load("label_encoders_RF0.pkl")
+def get_prediction_cache():
+    # one LRU cache for all the sessions
+    return PredictionCache(max_entries=4096)
+
+def get_predictor(algorithm = "rf"):
+    # model of the single booking predictions: the flat forest for the random forest, the sklearn model otherwise
+    if algorithm == "rf":
+        return get_forest()
+    return get_model(algorithm)[0]
+
+def trained_algorithms(model_dir = ".") -> list:
+    #Algorithms with metrics saved in model_dir, in the order of ALGORITHMS.
+    return [algorithm for algorithm, files in ALGORITHMS.items()
+        if os.path.exists(os.path.join(model_dir, files["metrics"]))]
+
+# Warm up of the caches in a background thread, started by home.py once per server process:
+# while the first visitor gets the first elements of the page, the cube, the map layers,
+# the smoothed adr, scipy and the small model artifacts are loaded (the sklearn pickle,
+# 1 GB in memory, is left to the batch scoring). Disabled with HOTEL_WARMUP=0.
+WARMUP_ENV_VAR = "HOTEL_WARMUP"
+_warmup = None
+_warmup_lock = threading.Lock()
+
+def warm_caches():
+    #The same calls (and arguments) of the pages, so the cached entries are the ones they look up.
+    #A step that fails (e.g. a missing artifact) is reported and the others go on.
+    version = dataset_version()
+    steps = [
+        ("cube", lambda: get_cube(version)),
+        *[(f"maps {projection}", lambda projection=projection: get_maps(projection, version))
+            for projection in PROJECTION_DETAIL],
+        ("smoothed adr", lambda: get_smoothed_adr(LOESS_BANDWIDTH, version)),
+        ("scipy", lambda: importlib.import_module("scipy.stats")),
+        *[(f"metrics {algorithm}", lambda algorithm=algorithm: get_metrics(algorithm))
+            for algorithm in trained_algorithms()],
+        ("encoders", get_encoders),
+        ("forest", get_forest),
+    ]
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            print(f"warm up of {name} failed: {e!r}")
+
+def start_warmup():
+    #Start warm_caches in a daemon thread, only the first time it is called in the process.
+    global _warmup
+    if os.environ.get(WARMUP_ENV_VAR, "1") == "0":
+        return None
+    with _warmup_lock:
+        if _warmup is None:
+            _warmup = threading.Thread(target=warm_caches, name="cache-warmup", daemon=True)
+            _warmup.start()
+    return _warmup
+
+def model_version(model_dir = ".", algorithm = "rf") -> str:
+    #Size and modification time of the artifacts: a retrained model changes the keys of the prediction cache.
+    parts = [algorithm]
+    names = [ALGORITHMS[algorithm]["model"], ENCODERS_FILE]
+    if algorithm == "rf":
+        names.append(os.path.join(FOREST_DIR, "forest.json"))
+    for name in names:
+        path = os.path.join(model_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}-{stat.st_mtime_ns}")
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+def encoders_path(model_dir = ".") -> str:
+    # encoders_RF0.json, or the LabelEncoders of models trained before it
+    path = os.path.join(model_dir, ENCODERS_FILE)
+    if not os.path.exists(path):
+        path = os.path.join(model_dir, "label_encoders_RF0.pkl")
+    return path
+
+def load_forest(model_dir = ".") -> FlatForest:
+    #Flat forest from its artifact (memory mapped), or compiled from the pickle for models trained before it.
+    path = os.path.join(model_dir, FOREST_DIR)
+    if os.path.exists(os.path.join(path, "forest.json")):
+        return FlatForest.load(path)
+    return FlatForest.from_model(joblib.load(os.path.join(model_dir, MODEL_FILE)))
+
+def load_model(model_dir = ".", engine = "sklearn", algorithm = "rf"):
+# Load pre-trained model, metrics and the categories of the encoder from file
+# (without the Streamlit cache, for the scoring service). The flat engine applies only to the random forest.
+    files = ALGORITHMS[algorithm]
+    if engine == "flat" and algorithm == "rf":
+        model = load_forest(model_dir)
+    else:
+        model = joblib.load(os.path.join(model_dir, files["model"]))
+    metrics = joblib.load(os.path.join(model_dir, files["metrics"]))
+    label_encoder = load_encoders(encoders_path(model_dir))
     return model, metrics, label_encoder
 
-def get_data(preprocess = True) -> pl.DataFrame:
+# month name -> month number, used to build arrival_date
+MONTHS = {"January": 1, "February": 2, "March": 3, "April": 4,
+    "May": 5, "June": 6, "July": 7, "August": 8,
+    "September": 9, "October": 10, "November": 11, "December": 12}
+
+# Declared schema of the cleaned bookings table.
+# Low cardinality strings are Enum (categories in alphabetical order, like the LabelEncoder),
+# country is Categorical because new countries can appear, numbers use the smallest width that fits.
+ROOM_TYPES = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "K", "L", "P"]
+SCHEMA = {
+    "index": pl.UInt32,
+    "hotel": pl.Enum(["City Hotel", "Resort Hotel"]),
+    "is_canceled": pl.Int8,
+    "lead_time": pl.Int16,
+    "arrival_date_year": pl.Int16,
+    "arrival_date_month": pl.Enum(list(MONTHS)),
+    "arrival_date_week_number": pl.Int8,
+    "arrival_date_day_of_month": pl.Int8,
+    "stays_in_weekend_nights": pl.Int8,
+    "stays_in_week_nights": pl.Int8,
+    "adults": pl.Int8,
+    "children": pl.Int8,
+    "babies": pl.Int8,
+    "meal": pl.Enum(["BB", "FB", "HB", "SC"]),
+    "country": pl.Categorical,
+    "market_segment": pl.Enum(["Aviation", "Complementary", "Corporate", "Direct",
+        "Groups", "Offline TA/TO", "Online TA"]),
+    "distribution_channel": pl.Enum(["Corporate", "Direct", "GDS", "TA/TO"]),
+    "is_repeated_guest": pl.Int8,
+    "previous_cancellations": pl.Int8,
+    "previous_bookings_not_canceled": pl.Int8,
+    "reserved_room_type": pl.Enum(ROOM_TYPES),
+    "assigned_room_type": pl.Enum(ROOM_TYPES),
+    "booking_changes": pl.Int8,
+    "deposit_type": pl.Enum(["No Deposit", "Non Refund", "Refundable"]),
+    "days_in_waiting_list": pl.Int16,
+    "customer_type": pl.Enum(["Contract", "Group", "Transient", "Transient-Party"]),
+    "adr": pl.Float32,
+    "required_car_parking_spaces": pl.Int8,
+    "total_of_special_requests": pl.Int8,
+    "reservation_status": pl.Enum(["Canceled", "Check-Out", "No-Show"]),
+    "reservation_status_date": pl.Date,
+    "arrival_date_month_n": pl.Int8,
+    "arrival_date": pl.Date,
+}
+
+def get_data(preprocess = True, lazy = False, path = "hotel_bookings.csv") -> pl.DataFrame:
     #Load and preprocess data.
-   
+    #With lazy=True the csv is scanned and the whole cleaning runs as one optimized query
+    #on the streaming engine (lower peak memory).
+
+    if lazy:
+        query = pl.scan_csv(path, null_values= NULL_VALUES)
+        if preprocess:
+            query = clean(query)
+        return query.collect(engine="streaming")
+
     # Load data
-    data  = pl.read_csv("hotel_bookings.csv", null_values= ["Undefined","NA"])
+    data  = pl.read_csv(path, null_values= NULL_VALUES)
     if preprocess:   
         # Drop columns that are not needed
         data.drop_in_place("agent")
@@ -82,35 +314,192 @@ def get_data(preprocess = True) -> pl.DataFrame:
         data = data.with_columns(
             pl.col("arrival_date").str.strptime(pl.Date, "%Y-%m-%d")
         )
+        data = data.cast(SCHEMA)
     return data
 
+def snapshot_key(path = "hotel_bookings.csv") -> str:
+    #Hash of the source csv and of the cleaning rules (code of clean, corrections, schema and null values).
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        h.update(hashlib.file_digest(f, "sha256").digest())
+    h.update(inspect.getsource(clean).encode())
+    h.update(repr(CORRECTIONS).encode())
+    h.update(repr(SCHEMA).encode())
+    h.update(repr(NULL_VALUES).encode())
+    return h.hexdigest()[:16]
+
+
+def save_ipc(data, target):
+    #Write an uncompressed IPC file to a temporary file and rename it,
+    #so a concurrent reader never sees half a file.
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    data.write_ipc(tmp, compression="uncompressed")
+    os.replace(tmp, target)
+
+def remove_stale(cache_dir, pattern, keep):
+    #Remove the cache files matching pattern, except the ones in keep.
+    for old in glob.glob(os.path.join(cache_dir, pattern)):
+        if os.path.basename(old) not in keep:
+            os.remove(old)
+
+def manifest_path(path = "hotel_bookings.csv", cache_dir = CACHE_DIR) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}_manifest.json")
 
-def get_mapdata(data = None) -> gpd.GeoDataFrame:
+def read_manifest(path = "hotel_bookings.csv", cache_dir = CACHE_DIR):
+    #Manifest written by ingest.append_bookings (None if no batch has been appended):
+    #key of the source csv, current version, snapshot and cube files.
+    try:
+        with open(manifest_path(path, cache_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def dataset_version(path = "hotel_bookings.csv", cache_dir = CACHE_DIR) -> str:
+    #Cheap identifier of the current dataset, used as key of the streamlit caches:
+    #version of the last appended batch, otherwise size and modification time of the csv.
+    stat = os.stat(path)
+    manifest = read_manifest(path, cache_dir)
+    if manifest is not None and manifest["csv"] == [stat.st_size, stat.st_mtime_ns]:
+        return manifest["version"]
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def get_snapshot(path = "hotel_bookings.csv", cache_dir = CACHE_DIR) -> pl.DataFrame:
+    #Cleaned dataset loaded from an Arrow IPC snapshot with memory mapping.
+    #The snapshot is rebuilt when the csv or the cleaning rules change, the file is
+    #uncompressed so that processes on the same host share the same pages.
+    #If batches were appended to this csv (ingest.py) their snapshot is returned.
+    stem = os.path.splitext(os.path.basename(path))[0]
+    key = snapshot_key(path)
+    manifest = read_manifest(path, cache_dir)
+    if manifest is not None and manifest["source"] == key:
+        return pl.read_ipc(os.path.join(cache_dir, manifest["snapshot"]), memory_map=True)
+    snapshot = f"{stem}_{key}.arrow"
+    if not os.path.exists(os.path.join(cache_dir, snapshot)):
+        save_ipc(get_data(lazy=True, path=path), os.path.join(cache_dir, snapshot))
+        # remove snapshots of older versions of the csv (and the batches appended to them)
+        remove_stale(cache_dir, f"{stem}_*.arrow", [snapshot])
+        if manifest is not None:
+            os.remove(manifest_path(path, cache_dir))
+    return pl.read_ipc(os.path.join(cache_dir, snapshot), memory_map=True)
+
+# Corrections of the raw bookings that keep every row: used by clean and, for the bookings
+# to score (scoring.derive_features), together with the feature derived in training.
+CORRECTIONS = [
+    # impute missing values in meal
+    pl.col("meal").fill_null("SC"),
+    #fix error in country names (a string also when the file has it as categorical)
+    pl.col("country").cast(pl.String).replace("CN", "CAN"),
+]
+SAME_ROOM_TYPE = pl.when(pl.col("reserved_room_type") == pl.col("assigned_room_type")
+    ).then(pl.lit(1)).otherwise(pl.lit(0)).alias("same_room_type")
+
+def clean(query: pl.LazyFrame) -> pl.LazyFrame:
+    #Same cleaning steps of get_data as a single lazy plan:
+    #unused columns are never read and the date is built from integers.
+
+    adr = pl.col("adr")
+    month = pl.col("arrival_date_month").replace_strict(MONTHS, return_dtype=pl.Int8)
+    return query.drop("agent", "company").with_columns(
+        # remove outliers and errors in adr
+        pl.when((adr < 0) | (adr > 5000) |
+            ((adr == 0) & (pl.col("market_segment") != "Complementary")))
+        .then(None).otherwise(adr).alias("adr"),
+        *CORRECTIONS,
+    ).drop_nulls().with_columns(
+        month.alias("arrival_date_month_n"),
+        pl.date(pl.col("arrival_date_year"), month, pl.col("arrival_date_day_of_month")).alias("arrival_date"),
+    ).cast(SCHEMA)
+
+
+# Levels of detail of the world layer: simplification tolerance (degrees) and clip box.
+# The projections used in the page pick the level.
+MAP_DETAIL = {
+    "world": {"tolerance": 0.1, "bbox": None},
+    "europe": {"tolerance": 0.02, "bbox": (-35, 25, 55, 75)},
+}
+PROJECTION_DETAIL = {"equalEarth": "world", "azimuthalEqualArea": "europe"}
+
+def simplify_world(path, detail) -> gpd.GeoDataFrame:
+    #Read the shapefile keeping only the country code and simplify the polygons
+    #as a coverage, so that borders shared by two countries stay shared.
+    import geopandas as gpd
+    import shapely
+    world = gpd.read_file(path, columns=["ADM0_A3_US"])
+    opts = MAP_DETAIL[detail]
+    geometry = shapely.coverage_simplify(world.geometry.values, opts["tolerance"])
+    if opts["bbox"] is not None:
+        geometry = shapely.clip_by_rect(geometry, *opts["bbox"])
+    world = world.set_geometry(gpd.GeoSeries(geometry, crs=world.crs))
+    return world[~world.geometry.is_empty]
+
+def get_world(detail = "world", path = "ne_10m_admin_0_countries.zip", cache_dir = CACHE_DIR) -> gpd.GeoDataFrame:
+    #Simplified world layer, computed once and stored in cache_dir (geometry as WKB in an IPC file).
+    #The file name depends on the shapefile and on the level of detail.
+    import geopandas as gpd
+    import shapely
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        h.update(hashlib.file_digest(f, "sha256").digest())
+    h.update(repr(MAP_DETAIL[detail]).encode())
+    h.update(inspect.getsource(simplify_world).encode())
+    name = f"world_{detail}_{h.hexdigest()[:16]}.arrow"
+    store = os.path.join(cache_dir, name)
+    if not os.path.exists(store):
+        world = simplify_world(path, detail)
+        save_ipc(pl.DataFrame({
+            "ADM0_A3_US": world["ADM0_A3_US"].to_list(),
+            "geometry": shapely.to_wkb(world.geometry.values),
+        }), store)
+        remove_stale(cache_dir, f"world_{detail}_*.arrow", [name])
+    stored = pl.read_ipc(store)
+    return gpd.GeoDataFrame({"ADM0_A3_US": stored["ADM0_A3_US"].to_list()},
+        geometry=shapely.from_wkb(stored["geometry"].to_numpy()), crs="EPSG:4326")
+
+def get_mapdata(data = None, projection = "equalEarth") -> gpd.GeoDataFrame:
 
     #Load the world map data and merge it with the data provided.
     #If no data is provided, return the world map data only.
+    #data can also be already aggregated by country (columns country, count, rate_cancelled).
+    #The level of detail of the polygons depends on the projection.
    
-    path = "ne_10m_admin_0_countries.zip"
-    world = gpd.read_file(path)
+    world = get_world(PROJECTION_DETAIL[projection])
     if data is None:
         return world
     else:
-        aggr = data.group_by("country").agg(pl.col("country").count().alias("count"),pl.col("is_canceled").mean().alias("rate_cancelled"))
-        data_pd = aggr.to_pandas()
+        if "rate_cancelled" in data.columns:
+            aggr = data
+        else:
+            aggr = data.group_by("country").agg(pl.col("country").count().alias("count"),pl.col("is_canceled").mean().alias("rate_cancelled"))
+        # plain strings for the merge with the shapefile codes
+        aggr = aggr.select("country", "count", "rate_cancelled").with_columns(pl.col("country").cast(pl.String))
+        with section("to_pandas"):
+            data_pd = aggr.to_pandas()
         map_data = world.merge(data_pd, left_on="ADM0_A3_US", right_on="country")
         return map_data
 
 
 ### Functions:
 
-def add_map(chart):
- #Salva la mappa come file html e la carica in streamlit
-    chart.save("map.html")
-    with open("map.html") as fp:
-        st.components.v1.html(fp.read(), width=600, height=600)
+@cached(max_entries=32)
+def map_html(_chart, key) -> str:
+ #Html della mappa generato in memoria, in cache per i parametri della mappa (key):
+ #_chart non viene hashato e viene serializzato solo se la chiave non è in cache
+    return _chart.to_html()
+
+def add_map(chart, *key):
+ #Carica la mappa in streamlit, a parità di parametri l'html è riusato
+ #(nessun file su disco, quindi sessioni concorrenti non si sovrascrivono)
+    with section("map_html"):
+        html = map_html(chart, key)
+    with section("components.html"):
+        st.components.v1.html(html, width=600, height=600)
 
+@profiled()
 def chi2(observed):
 #    Perform a chi-squared test on the data provided.
+    from scipy.stats import chi2_contingency
     chi2, pvalue, df, exp =  chi2_contingency(observed)
     return round(chi2,2), pvalue
 
@@ -125,7 +514,7 @@ def bar_chart(data, x, y, color = None, palette = None):
 
     chart = alt.Chart(data).mark_bar().encode(
         alt.X(x+":N", title=x),
-        alt.Y(y, title=y))
+        alt.Y(y, title=y.split(":")[0]))
     if color is None:
         return chart
     else:
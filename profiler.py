@@ -0,0 +1,192 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+# Opt-in profiler of the reruns of the pages. home.py opens a record at every rerun
+# (start_run) and closes it after the page (panel); inside the page checkpoint("name")
+# closes the current section and opens the next one, section("name") / @profiled time a
+# nested operation (cache loads, to_pandas, the chi-square, the html of the maps).
+# @fragment("name") is st.fragment plus a section; when only the fragment reruns (a
+# widget inside it changed) its run is recorded on its own and exported with the others.
+# The last reruns are shown in a sidebar panel and exported as a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev).
+#
+# Enabled for every session with HOTEL_PROFILE=1, or for one session with ?profile=1 in the url.
+# With HOTEL_PROFILE_TRACE=path the trace of the last reruns of all the sessions is also written to path.
+# When disabled every call is a no-op.
+#
+# usage: HOTEL_PROFILE=1 uv run streamlit run home.py
+
+ENV_VAR = "HOTEL_PROFILE"
+TRACE_ENV_VAR = "HOTEL_PROFILE_TRACE"
+# reruns kept for the export (all the sessions)
+MAX_RUNS = 200
+
+# record of the rerun of the script thread; sessions run in different threads
+_local = threading.local()
+_runs = deque(maxlen=MAX_RUNS)
+_lock = threading.Lock()
+# session id -> thread id of the trace
+_sessions = {}
+
+
+class Run:
+    def __init__(self, page, session):
+        self.page = page
+        self.session = session
+        self.start = time.perf_counter()
+        self.end = None
+        # (name, kind, start, end): kind "section" for the checkpoints, "call" for the nested operations
+        self.events = []
+        self.open = None
+
+    def close_section(self, now):
+        if self.open is not None:
+            name, start = self.open
+            self.events.append((name, "section", start, now))
+            self.open = None
+
+    def total_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+
+def enabled() -> bool:
+    if os.environ.get(ENV_VAR, "") not in ("", "0"):
+        return True
+    try:
+        return st.query_params.get("profile") == "1"
+    except Exception:
+        # outside a Streamlit session (scripts, tests)
+        return False
+
+def session_id() -> str:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "main"
+
+def current():
+    return getattr(_local, "run", None)
+
+def start_run(page):
+    #Open the record of a rerun of page (nothing if the profiler is disabled).
+    _local.run = Run(page, session_id()) if enabled() else None
+    # until the first checkpoint: the imports and the setup of the page
+    checkpoint("avvio")
+
+def checkpoint(name):
+    #Close the open section of the page and open the section name.
+    run = current()
+    if run is None:
+        return
+    now = time.perf_counter()
+    run.close_section(now)
+    run.open = (name, now)
+
+@contextmanager
+def section(name):
+    #Time a nested operation of the rerun.
+    run = current()
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.events.append((name, "call", start, time.perf_counter()))
+
+def profiled(name = None):
+    #Decorator: every call of the function is a section (also the cached loaders: the time of a hit is the lookup).
+    def decorator(func):
+        label = name or func.__name__
+        def wrapper(*args, **kwargs):
+            with section(label):
+                return func(*args, **kwargs)
+        functools.update_wrapper(wrapper, func, updated=())
+        # the cache functions keep their clear()
+        if hasattr(func, "clear"):
+            wrapper.clear = func.clear
+        return wrapper
+    return decorator
+
+def fragment(name):
+    #Decorator: st.fragment whose runs are profiled. Inside a full rerun it is a section of the page,
+    #when it reruns alone it is a run of its own (shown in the trace, the panel is drawn by full reruns only).
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            run = current()
+            if run is not None and run.end is None:
+                with section(name):
+                    return func(*args, **kwargs)
+            _local.run = Run(f"{name} (fragment)", session_id()) if enabled() else None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish_run()
+        return st.fragment(wrapper)
+    return decorator
+
+def finish_run():
+    #Close the record of the rerun, keep it for the export and return it.
+    run = current()
+    if run is None or run.end is not None:
+        return run
+    run.end = time.perf_counter()
+    run.close_section(run.end)
+    with _lock:
+        _runs.append(run)
+    path = os.environ.get(TRACE_ENV_VAR)
+    if path:
+        write_trace(path)
+    return run
+
+def chrome_trace(runs) -> dict:
+    #Trace Event Format: one complete event ("X") per rerun, section and call, one thread per session.
+    events = []
+    pid = os.getpid()
+    for run in runs:
+        with _lock:
+            tid = _sessions.setdefault(run.session, len(_sessions) + 1)
+        events.append({"name": run.page, "cat": "rerun", "ph": "X", "pid": pid, "tid": tid,
+            "ts": run.start * 1e6, "dur": (run.end - run.start) * 1e6, "args": {"session": run.session}})
+        for name, kind, start, end in run.events:
+            events.append({"name": name, "cat": kind, "ph": "X", "pid": pid, "tid": tid,
+                "ts": start * 1e6, "dur": (end - start) * 1e6, "args": {"page": run.page}})
+    with _lock:
+        names = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": f"session {session[:8]}"}}
+            for session, tid in _sessions.items()]
+    return {"traceEvents": names + events, "displayTimeUnit": "ms"}
+
+def runs(session = None) -> list:
+    with _lock:
+        return [run for run in _runs if session is None or run.session == session]
+
+def write_trace(path, session = None):
+    # written to a temporary file and renamed, a reader never sees half a trace
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(chrome_trace(runs(session)), f)
+    os.replace(tmp, path)
+
+def panel():
+    #Sidebar panel of the last rerun of the session, with the download of the traces.
+    run = finish_run()
+    if run is None:
+        return
+    with st.sidebar.expander(f"Profiler: {run.total_ms():.0f} ms", expanded=True):
+        rows = [{"sezione": name if kind == "section" else f"  ↳ {name}", "ms": (end - start) * 1000,
+            "%": (end - start) * 100000 / run.total_ms()} for name, kind, start, end in sorted(run.events, key=lambda e: e[2])]
+        st.dataframe(rows, hide_index=True, column_config={"ms": st.column_config.NumberColumn(format="%.1f"),
+            "%": st.column_config.ProgressColumn(min_value=0, max_value=100, format="%.0f%%")})
+        st.download_button("Trace della sessione (JSON)", json.dumps(chrome_trace(runs(run.session))),
+            file_name="trace_session.json", mime="application/json")
+        st.download_button("Trace di tutte le sessioni (JSON)", json.dumps(chrome_trace(runs())),
+            file_name="trace_all.json", mime="application/json")
+        st.caption("Aprire con chrome://tracing o ui.perfetto.dev")
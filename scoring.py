@@ -0,0 +1,118 @@
+import os
+import weakref
+
+import numpy as np
+import polars as pl
+
+from encoders import FALLBACK, encode, to_matrix
+from preprocess import CORRECTIONS, NULL_VALUES, SAME_ROOM_TYPE, SCHEMA
+
+# Batch scoring of a file of bookings in the raw hotel_bookings.csv schema:
+# the file is read, derived, encoded and scored one chunk at a time and the
+# probabilities are appended to the output csv, so the memory used depends on
+# the chunk size and not on the size of the file.
+
+CHUNK_ROWS = 20_000
+
+# numeric types of the raw columns, so that every chunk of a csv is read with the same schema
+RAW_TYPES = {col: dtype for col, dtype in SCHEMA.items()
+    if dtype.is_numeric() and col not in ("index", "arrival_date_month_n")}
+
+
+def count_rows(path) -> int:
+    #Number of bookings in the file, for the progress bar (csv: lines read in blocks, without parsing).
+    if path.endswith(".parquet"):
+        # from the metadata of the file
+        return pl.scan_parquet(path).select(pl.len()).collect().item()
+    lines = 0
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            lines += block.count(b"\n")
+    return max(lines - 1, 0)
+
+def normalize(chunk) -> pl.DataFrame:
+    #Types of the csv chunks for a chunk read from parquet: the missing value tokens become null and the
+    #numeric columns are cast (a parquet export of hotel_bookings.csv has children as strings with "NA").
+    strings = [col for col, dtype in chunk.schema.items() if dtype == pl.String]
+    return chunk.with_columns(
+        pl.when(pl.col(col).is_in(NULL_VALUES)).then(None).otherwise(pl.col(col)).alias(col) for col in strings
+    ).cast({col: dtype for col, dtype in RAW_TYPES.items() if col in chunk.columns}, strict=False)
+
+def iter_chunks(path, chunk_rows = CHUNK_ROWS):
+    #Chunks of chunk_rows bookings of a csv or parquet file.
+    if path.endswith(".parquet"):
+        # the slice is pushed down to the reader: only the row groups of the chunk are read
+        scan = pl.scan_parquet(path)
+        for offset in range(0, count_rows(path), chunk_rows):
+            yield normalize(scan.slice(offset, chunk_rows).collect())
+        return
+    reader = pl.read_csv_batched(path, batch_size=chunk_rows, null_values=NULL_VALUES,
+        schema_overrides=RAW_TYPES)
+    # the batches of the reader are much smaller than batch_size (their size depends on the
+    # threads of polars): they are joined into chunks of exactly chunk_rows bookings
+    pending, rows = [], 0
+    while batches := reader.next_batches(16):
+        pending.extend(batches)
+        rows += sum(len(batch) for batch in batches)
+        while rows >= chunk_rows:
+            joined = pl.concat(pending, how="vertical_relaxed")
+            yield joined.slice(0, chunk_rows)
+            pending, rows = [joined.slice(chunk_rows)], rows - chunk_rows
+    if rows:
+        yield pl.concat(pending, how="vertical_relaxed")
+
+def derive_features(chunk, feature_names) -> pl.DataFrame:
+    #Features of the model from raw bookings, with the same corrections of preprocess.clean
+    #that do not drop rows (meal "Undefined" -> "SC", country "CN" -> "CAN").
+    return chunk.with_columns(CORRECTIONS).with_columns(SAME_ROOM_TYPE).select(feature_names)
+
+def score_chunk(chunk, model, encoders, feature_names) -> pl.DataFrame:
+    #The chunk with the probability of cancellation. Bookings that can not be scored
+    #(missing values or categories unknown to the model) get a null probability.
+    features = derive_features(chunk, feature_names)
+    valid = pl.all_horizontal(pl.all().is_not_null())
+    for col, categories in encoders.items():
+        if col in feature_names and col not in FALLBACK:
+            valid = valid & pl.col(col).cast(pl.String).is_in(categories)
+    mask = features.select(valid.fill_null(False)).to_series()
+
+    prob = np.full(chunk.shape[0], np.nan)
+    if mask.any():
+        X = to_matrix(encode(features.filter(mask), encoders))
+        prob[mask.to_numpy()] = model.predict_proba(X)[:, 1]
+    return chunk.with_columns(pl.Series("cancel_probability", prob).fill_nan(None))
+
+def score_file(in_path, out_path, model, encoders, feature_names, progress = None) -> int:
+    #Score in_path chunk by chunk, appending to the csv out_path.
+    #progress(done, total) is called after every chunk. Returns the number of bookings.
+    total = count_rows(in_path)
+    done = 0
+    with open(out_path, "w") as out:
+        for chunk in iter_chunks(in_path):
+            score_chunk(chunk, model, encoders, feature_names).write_csv(out, include_header=(done == 0))
+            done += chunk.shape[0]
+            if progress is not None:
+                progress(done, total)
+    return done
+
+def what_if(model, encoders, feature_names, base, field, values, by = "deposit_type") -> pl.DataFrame:
+    #Probability of cancellation of the booking base (a dict of raw fields) when field takes each of values,
+    #for every category of by: the whole grid is built with a cross join and scored with one predict_proba call.
+    grid = pl.DataFrame([base]).drop(field, by).join(
+        pl.DataFrame({field: values}).join(pl.DataFrame({by: encoders[by]}), how="cross"), how="cross")
+    X = to_matrix(encode(derive_features(grid, feature_names), encoders))
+    return grid.select(field, by).with_columns(pl.Series("cancel_probability", model.predict_proba(X)[:, 1]))
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+class ScoredFile:
+    #Output csv of score_file owned by the object (the Modello page keeps it in the session state):
+    #the file is removed by remove() or, at the latest, when the object is garbage collected,
+    #so the result of an abandoned session does not stay in the temporary folder.
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.remove = weakref.finalize(self, remove_file, path)
@@ -0,0 +1,313 @@
+import argparse
+import http.client
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+import polars as pl
+
+from preprocess import NULL_VALUES, SCHEMA, load_model
+from scoring import score_chunk
+
+# Local HTTP scoring service for the PMS integration.
+# The model and the encoders are loaded once; the bookings of concurrent requests
+# are collected for at most max_wait_ms (or max_batch bookings) and scored with a
+# single predict_proba call.
+#
+#   POST /predict   {"bookings": [{...}, ...]} (or a single booking) -> {"cancel_probability": [...]}
+#   GET  /metrics   latency and throughput counters
+#   GET  /health
+#
+# usage: uv run python service.py serve --port 8000
+#        uv run python service.py loadgen --concurrency 16 --requests 2000
+
+
+def request_schema(feature_names) -> dict:
+    #Columns read from the json bookings: categorical features as strings, numeric ones as float.
+    schema = {}
+    for col in feature_names:
+        if col not in SCHEMA:
+            # derived features (same_room_type)
+            continue
+        schema[col] = pl.Float64 if SCHEMA[col].is_numeric() else pl.String
+    return schema
+
+def parse_bookings(bookings, schema) -> list:
+    #Bookings of one request with only the columns of the schema. The missing value tokens of the
+    #csv (NULL_VALUES) become null and numbers sent as strings are converted; a value that does not
+    #fit its column raises ValueError (400), so a bad request never reaches the micro-batch of the others.
+    rows = []
+    for i, booking in enumerate(bookings):
+        row = {}
+        for col, dtype in schema.items():
+            value = booking.get(col)
+            if isinstance(value, str) and value in NULL_VALUES:
+                value = None
+            if value is None:
+                pass
+            elif isinstance(value, (dict, list)):
+                raise ValueError(f"booking {i}: {col} must be a single value, got {value!r}")
+            elif dtype == pl.Float64:
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError(f"booking {i}: {col} must be a number, got {value!r}") from None
+            else:
+                value = str(value)
+            row[col] = value
+        rows.append(row)
+    return rows
+
+
+class Stats:
+    #Counters of the service, updated by the request threads and the batching thread.
+    def __init__(self, window = 10_000):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.requests = self.bookings = self.batches = self.errors = 0
+
+    def request(self, latency, bookings):
+        with self.lock:
+            self.requests += 1
+            self.bookings += bookings
+            self.latencies.append(latency)
+
+    def batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def report(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            uptime = time.perf_counter() - self.start
+            return {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "bookings": self.bookings,
+                "batches": self.batches,
+                "errors": self.errors,
+                "requests_per_s": self.requests / uptime,
+                "bookings_per_batch": self.bookings / max(self.batches, 1),
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+
+class MicroBatcher:
+    #Collects the bookings of concurrent requests and scores them together in a background thread.
+    def __init__(self, model, encoders, feature_names, max_batch = 256, max_wait_ms = 2.0):
+        self.model = model
+        self.encoders = encoders
+        self.feature_names = feature_names
+        self.schema = request_schema(feature_names)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def predict(self, bookings) -> list:
+        #Probability of cancellation of every booking (None if it can not be scored).
+        future = Future()
+        self.queue.put((bookings, future))
+        return future.result()
+
+    def loop(self):
+        while True:
+            # wait for the first request, then collect the others until the batch is full or the time is over
+            items = [self.queue.get()]
+            size = len(items[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                size += len(items[-1][0])
+            self.score(items)
+
+    def score(self, items):
+        rows = [booking for bookings, _ in items for booking in bookings]
+        try:
+            # the bookings were checked by parse_bookings: a failure here is an error of the service
+            frame = pl.from_dicts(rows, schema=self.schema)
+            prob = score_chunk(frame, self.model, self.encoders, self.feature_names)["cancel_probability"].to_list()
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+        self.stats.batch()
+        start = 0
+        for bookings, future in items:
+            future.set_result(prob[start:start + len(bookings)])
+            start += len(bookings)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive connections, the clients of the PMS send many small requests
+    protocol_version = "HTTP/1.1"
+    # headers and body are two writes: without TCP_NODELAY the body waits for the delayed ack of the client
+    disable_nagle_algorithm = True
+    batcher = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.batcher.stats.report())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/predict":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            payload = json.loads(body)
+            bookings = payload["bookings"] if isinstance(payload, dict) and "bookings" in payload else payload
+            if isinstance(bookings, dict):
+                bookings = [bookings]
+            if not isinstance(bookings, list) or not all(isinstance(b, dict) for b in bookings):
+                raise ValueError("expected a booking or a list of bookings")
+            bookings = parse_bookings(bookings, self.batcher.schema)
+        except ValueError as e:
+            self.batcher.stats.error()
+            self.send_json(400, {"error": str(e)})
+            return
+        try:
+            prob = self.batcher.predict(bookings) if bookings else []
+        except Exception as e:
+            self.batcher.stats.error()
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"cancel_probability": prob})
+        self.batcher.stats.request(time.perf_counter() - start, len(bookings))
+
+    def log_message(self, format, *args):
+        # no line per request
+        pass
+
+
+def make_server(host = "127.0.0.1", port = 8000, model_dir = ".", max_batch = 256, max_wait_ms = 2.0, engine = "flat"):
+    # micro-batches are small: the flat arrays engine is faster than sklearn on them
+    model, metrics, encoders = load_model(model_dir, engine)
+    if engine == "sklearn":
+        # small batches: the trees are evaluated in the batching thread, without a joblib pool
+        model.n_jobs = 1
+    handler = type("ScoringHandler", (Handler,), {
+        "batcher": MicroBatcher(model, encoders, metrics["feature_names"], max_batch, max_wait_ms)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def load_generator(url, bookings, concurrency = 16, requests = 2000, batch = 1) -> dict:
+    #Send requests from concurrency threads (one keep-alive connection each) and measure
+    #the latency seen by the clients.
+    target = urlparse(url)
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        conn = http.client.HTTPConnection(target.hostname, target.port)
+        mine = []
+        for i in counter:
+            body = json.dumps({"bookings": bookings[(i * batch) % len(bookings):][:batch]})
+            start = time.perf_counter()
+            conn.request("POST", "/predict", body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            mine.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "bookings_per_request": batch,
+        "seconds": elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def sample_bookings(path, n = 1000) -> list:
+    #First n bookings of the csv as json objects, like the ones sent by the PMS.
+    return pl.read_csv(path, n_rows=n, null_values=NULL_VALUES).to_dicts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local scoring service of the cancellation model")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="start the http service")
+    load = sub.add_parser("loadgen", help="measure latency and throughput of the service")
+    for p in (serve, load):
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--port", type=int, default=8000)
+        p.add_argument("--model-dir", default=".")
+        p.add_argument("--max-batch", type=int, default=256, help="max bookings scored together")
+        p.add_argument("--max-wait-ms", type=float, default=2.0, help="max wait for other requests")
+        p.add_argument("--engine", choices=["flat", "sklearn"], default="flat", help="forest.FlatForest or model.predict_proba")
+    load.add_argument("--url", help="service to test; if not given a service is started in this process")
+    load.add_argument("--csv", default="hotel_bookings.csv", help="bookings sent in the requests")
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--requests", type=int, default=2000)
+    load.add_argument("--batch", type=int, default=1, help="bookings per request")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = make_server(args.host, args.port, args.model_dir, args.max_batch, args.max_wait_ms, args.engine)
+        print(f"scoring service on http://{args.host}:{args.port}")
+        server.serve_forever()
+        return
+
+    url = args.url
+    if url is None:
+        server = make_server(args.host, 0, args.model_dir, args.max_batch, args.max_wait_ms, args.engine)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://{args.host}:{server.server_address[1]}"
+    bookings = sample_bookings(args.csv)
+    # warm up (first predict_proba, connections)
+    load_generator(url, bookings, concurrency=2, requests=20, batch=args.batch)
+    print(json.dumps(load_generator(url, bookings, args.concurrency, args.requests, args.batch), indent=2))
+    target = urlparse(url)
+    conn = http.client.HTTPConnection(target.hostname, target.port)
+    conn.request("GET", "/metrics")
+    print("server", conn.getresponse().read().decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,61 @@
 
-from sklearn.ensemble import RandomForestClassifier
+import argparse
+import json
+import os
+import pickle
+import time
+from contextlib import contextmanager
+
+from threadpoolctl import threadpool_limits
+
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.inspection import permutation_importance
 from sklearn.model_selection import train_test_split, StratifiedKFold, cross_validate
 import sklearn.metrics as metrics 
-from sklearn.preprocessing import LabelEncoder
 import polars as pl
 import joblib  
 import numpy as np
-from app import data
+from preprocess import ALGORITHMS, ENCODERS_FILE, FOREST_DIR, SAME_ROOM_TYPE, get_snapshot
+from encoders import encode, fit_encoders, save_encoders, to_matrix
+from forest import FlatForest
+from cache import ByteCounter
+
+# Headless training pipeline: reads the cleaned dataset from the preprocessing layer
+# (the Arrow snapshot, no Streamlit page is executed) and reports the time of every stage.
+# Every algorithm of preprocess.ALGORITHMS is trained and evaluated in the same way and
+# saves the same model_metrics, so the Modello page can show any of them; with more
+# than one algorithm a report compares fit time, prediction latency, size and AUC.
+#
+# usage: uv run python trainmodel.py --overwrite
+#        uv run python trainmodel.py --overwrite --algorithm rf hgb
 
 # set random seed for reproducibility and parameters
 seed = 42
 num_c = 500 # min number of prenotations for keeping a country
 n_estimators = 100 # number of trees in the forest
+importance_rows = 10000 # bookings of the permutation importance (algorithms without feature_importances_)
 test_size = 0.2 # cross validation test size
 
 
-def preproc():
-   
+@contextmanager
+def stage(name, timings):
+    #Time a stage of the pipeline, saved in timings and printed.
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+    print(f"{name}: {timings[name]:.2f}s", flush=True)
+
+def preproc(data = None):
+    #Features and label encoders from the cleaned dataset (the snapshot if data is not given).
+    if data is None:
+        data = get_snapshot()
     df = data.drop("index","arrival_date","arrival_date_month","arrival_date_month_n",
                         "reservation_status","reservation_status_date",
                         "arrival_date_day_of_month", "arrival_date_year")
-    df = df.with_columns(pl.when(pl.col("reserved_room_type") == pl.col("assigned_room_type")
-        ).then(pl.lit(1)).otherwise(pl.lit(0)).alias("same_room_type"))
+    df = df.with_columns(SAME_ROOM_TYPE)
 
     # create other country 
+    df = df.with_columns(pl.col("country").cast(pl.Utf8))
     country_counts = df.group_by('country').len().sort('len', descending=True)
 
     countries = country_counts.filter(pl.col('len') > num_c)['country'].to_list() 
@@ -33,134 +65,261 @@ def preproc():
         .otherwise(pl.lit('Other'))
         .alias('country')
     )
-        # get categorical columns
+    # get categorical columns (Enum/Categorical from the declared schema)
     categorical_cols = []
     for col, dtype in zip(df.columns, df.dtypes):
-        if dtype == pl.Utf8:
+        if dtype in (pl.Utf8, pl.Categorical, pl.Enum):
             categorical_cols.append(col)
 
-    # Label encode categorical columns
-    label_encoders = {}
-    for col in categorical_cols:
-        labEnc = LabelEncoder()
-
-        # get unique values and create mapping
-        unique_vals = df[col].unique().to_list()
-        labEnc.fit(unique_vals)
-        label_encoders[col] = labEnc
-        
-        # mapping
-        mapping = {}
-        for val in unique_vals:
-            mapping[val] = labEnc.transform([val])[0]
-
-        # Apply encoding in Polars
-        df = df.with_columns(
-            pl.col(col).replace(mapping).alias(col)
-        )
+    # encode categorical columns with their codes (same codes of LabelEncoder)
+    label_encoders = fit_encoders(df, categorical_cols)
+    df = encode(df, label_encoders)
     return df, label_encoders
 
-def train_and_metric(df):
+TARGET_NAMES = ["Not Canceled", "Canceled"]
+CV_SCORING = ['accuracy', 'recall', 'precision', 'f1', 'roc_auc']
 
-    # Convert target and features to numpy for sklearn
-    y = df.select("is_canceled").to_numpy().flatten()
-    X = df.drop("is_canceled").to_numpy()
+def new_model(n_jobs = -1, params = None, algorithm = "rf", categorical = None):
+    # params: hyperparameters that replace the defaults (e.g. the best of tune.py)
+    # categorical: mask of the encoded columns, split natively by the gradient boosting
+    if algorithm == "hgb":
+        # the codes of the encoders are < 255, the limit of the categorical bins
+        return HistGradientBoostingClassifier(**(params or {}), categorical_features=categorical, random_state=seed)
+    params = {"n_estimators": n_estimators, **(params or {})}
+    return RandomForestClassifier(**params, random_state=seed, n_jobs=n_jobs)
 
-    # get feature names
-    feature_names = df.drop("is_canceled").columns
+def fit_fold(X, y, train, test, spec = None):
+    # executed in a worker process: one tree at a time, the folds run in parallel
+    # (and one OpenMP thread, the gradient boosting would start one per core in every worker)
+    with threadpool_limits(1):
+        model = new_model(n_jobs=1, **(spec or {})).fit(X[train], y[train])
+        return test, model.predict_proba(X[test])[:, 1]
 
-    # Train model
-    model = RandomForestClassifier(n_estimators= n_estimators, random_state=seed, n_jobs=-1)
+def fit_final(X, y, spec = None):
+    # with its fit time, for the comparison of the algorithms
+    start = time.perf_counter()
+    with threadpool_limits(1):
+        model = new_model(n_jobs=1, **(spec or {})).fit(X, y)
+    return model, time.perf_counter() - start
+
+def prob_metrics(y_true, y_prob) -> dict:
+    #Metrics of model_metrics computed from the predicted probabilities of the positive class.
+    # ties go to "Not Canceled" like model.predict
+    y_pred = (y_prob > 0.5).astype(y_true.dtype)
+    fpr, tpr, thresholds = metrics.roc_curve(y_true, y_prob)
+    return {
+        'auc_score': metrics.roc_auc_score(y_true, y_prob),
+        'classification_report': metrics.classification_report(y_true, y_pred,
+            target_names=TARGET_NAMES, output_dict=True),
+        'confusion_matrix': metrics.confusion_matrix(y_true, y_pred),
+        'roc_curve': {'fpr': fpr, 'tpr': tpr, 'thresholds': thresholds},
+    }
+
+def fold_scores(y_true, y_prob) -> dict:
+    #Same scores of cross_validate for one fold.
+    y_pred = (y_prob > 0.5).astype(y_true.dtype)
+    return {
+        'accuracy': metrics.accuracy_score(y_true, y_pred),
+        'recall': metrics.recall_score(y_true, y_pred),
+        'precision': metrics.precision_score(y_true, y_pred),
+        'f1': metrics.f1_score(y_true, y_pred),
+        'roc_auc': metrics.roc_auc_score(y_true, y_prob),
+    }
+
+def train_oof(X, y, folds = 5, n_jobs = -1, spec = None):
+    #Single pass evaluation: the stratified folds and the final model are fitted in parallel processes,
+    #every metric comes from the out-of-fold probabilities (each booking is predicted by the
+    #forest that did not see it) and the final model is fitted once on all the data.
+    cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    tasks = [joblib.delayed(fit_fold)(X, y, train, test, spec) for train, test in cv.split(X, y)]
+    tasks.append(joblib.delayed(fit_final)(X, y, spec))
+    *results, (model, fit_seconds) = joblib.Parallel(n_jobs=n_jobs)(tasks)
 
+    oof = np.empty(len(y))
+    for test, prob in results:
+        oof[test] = prob
+    model_metrics = prob_metrics(y, oof)
+    scores = [fold_scores(y[test], oof[test]) for test, _ in results]
+    model_metrics['cv_scores'] = {name: float(np.mean([s[name] for s in scores])) for name in CV_SCORING}
+    model_metrics['evaluation'] = {'mode': 'oof', 'folds': folds, 'samples': len(y)}
+    model_metrics['fit_seconds'] = fit_seconds
+    # the final forest predicts with all the cores (the boosting uses its threads anyway)
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=-1)
+    return model, model_metrics
+
+def train_holdout(X, y, spec = None):
+    #Previous evaluation: 80/20 split for the test metrics and a separate 5 fold cross_validate.
+    spec = spec or {}
+    model = new_model(**spec)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size= test_size, random_state=seed)
+    start = time.perf_counter()
     model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
     print("Model trained")
-
-    # get predicts
-    y_pred = model.predict(X_test)
-    y_pred_prob = model.predict_proba(X_test)
-
-    met = metrics.classification_report(y_test, y_pred, target_names=["Not Canceled", "Canceled"])
+    model_metrics = prob_metrics(y_test, model.predict_proba(X_test)[:, 1])
 
     # cross validation
     cv = StratifiedKFold(n_splits=5, shuffle=True, random_state=seed)
+    cv_results = cross_validate(new_model(**spec), X, y, cv=cv, scoring=CV_SCORING, return_train_score=False)
+    model_metrics['cv_scores'] = {name: cv_results[f'test_{name}'].mean() for name in CV_SCORING}
+    model_metrics['evaluation'] = {'mode': 'holdout', 'test_size': test_size, 'samples': len(y_test)}
+    model_metrics['fit_seconds'] = fit_seconds
+    return model, model_metrics
 
+def feature_importance(model, X, y):
+    #Importance of every feature, summing to 1: the impurity importance of the forest, or for the
+    #models without it the permutation importance (decrease of the AUC) on a sample of the bookings.
+    if hasattr(model, "feature_importances_"):
+        return model.feature_importances_
+    rows = np.random.default_rng(seed).permutation(len(y))[:importance_rows]
+    result = permutation_importance(model, X[rows], y[rows], scoring="roc_auc", n_repeats=5, random_state=seed)
+    importance = np.clip(result.importances_mean, 0, None)
+    return importance / importance.sum() if importance.sum() > 0 else importance
 
-    scoring = [
-        'accuracy',
-        'recall',
-        'precision',
-        'f1',
-        'roc_auc'
-    ]
+def train_and_metric(df, evaluation = "oof", n_jobs = -1, params = None, algorithm = "rf", categorical = ()):
+    # categorical: names of the encoded columns
 
-    cv_results = cross_validate(
-        model, X, y,
-        cv=cv,
-        scoring=scoring,
-        return_train_score=False
-    )
+    # Convert target and features to numpy for sklearn
+    y = df["is_canceled"].to_numpy()
+    X = to_matrix(df.drop("is_canceled"))
 
-    cv_metrics = {
-        'accuracy': cv_results['test_accuracy'].mean(),
-        'recall': cv_results['test_recall'].mean(),
-        'precision': cv_results['test_precision'].mean(),
-        'f1': cv_results['test_f1'].mean(),
-        'roc_auc': cv_results['test_roc_auc'].mean()
-    }
+    # get feature names
+    feature_names = df.drop("is_canceled").columns
+    spec = {"params": params, "algorithm": algorithm}
+    if algorithm == "hgb":
+        spec["categorical"] = [name in categorical for name in feature_names]
 
+    # Train model
+    if evaluation == "oof":
+        model, model_metrics = train_oof(X, y, n_jobs=n_jobs, spec=spec)
+    else:
+        model, model_metrics = train_holdout(X, y, spec)
 
     importance_dict = {}
+    importances = feature_importance(model, X, y)
 
     for idx in range(len(feature_names)):
         feature_name = feature_names[idx]
-        importance_value = model.feature_importances_[idx]
+        importance_value = importances[idx]
         importance_dict[feature_name] = float(importance_value)
 
+    model_metrics['feature_importance'] = importance_dict
+    model_metrics['feature_names'] = feature_names
+    model_metrics['params'] = model.get_params()
+    model_metrics['algorithm'] = algorithm
+    return model, model_metrics
 
-    auc_score = metrics.roc_auc_score(y_test, y_pred_prob[:, 1])
-    classification_rep = metrics.classification_report(y_test, y_pred, 
-        target_names=["Not Canceled", "Canceled"], output_dict=True)
-    
-    country_name = df.select("country").unique().to_series().to_list()
-
-    confusion_matrix = metrics.confusion_matrix(y_test, y_pred)
-    fpr, tpr, thresholds = metrics.roc_curve(y_test, y_pred_prob[:, 1])
-    model_metrics = {
-        'auc_score': auc_score,
-        'classification_report': classification_rep,
-        'confusion_matrix': confusion_matrix,
-        'roc_curve': {'fpr': fpr, 'tpr': tpr, 'thresholds': thresholds},
-        'feature_importance':  importance_dict,
-        'cv_scores': cv_metrics,
-        'feature_names': feature_names,
-        'country_names': country_name
+def speed_and_size(model, X, algorithm = "rf", repeat = 20) -> dict:
+    #Prediction times with the model used by the app (the flat forest for the single bookings of the
+    #random forest, the sklearn model for the batches) and size of the pickled model.
+    single = FlatForest.from_model(model) if algorithm == "rf" else model
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        single.predict_proba(X[i:i + 1])
+        times.append(time.perf_counter() - start)
+    batch = X[:4096]
+    start = time.perf_counter()
+    model.predict_proba(batch)
+    batch_seconds = time.perf_counter() - start
+    return {
+        "latency_ms": float(np.median(times)) * 1000,
+        "batch_ms_per_1k": batch_seconds * 1000 / len(batch) * 1000,
+        "model_mb": pickled_size(model) / 2**20,
     }
-    return model, model_metrics
+
+def pickled_size(model) -> int:
+    # bytes counted while pickling, without building the pickle in memory
+    counter = ByteCounter()
+    pickle.dump(model, counter, protocol=pickle.HIGHEST_PROTOCOL)
+    return counter.nbytes
 
 def exist(file_path):
-    try:
-        with open(file_path, 'rb'):
-            return True
-    except FileNotFoundError:
-        return False
+    # files and the directory of the forest artifact
+    return os.path.exists(file_path)
     
+def save_outputs(outputs, out_dir, overwrite):
+    os.makedirs(out_dir, exist_ok=True)
+    for name, save in outputs.items():
+        target = os.path.join(out_dir, name)
+        # existing files are kept unless overwrite is asked
+        if overwrite or not exist(target):
+            save(target)
+        else:
+            print(f"{target} exists, not saved (use --overwrite)")
+
+def run(csv = "hotel_bookings.csv", out_dir = ".", overwrite = False, evaluation = "oof", n_jobs = -1,
+        compress = False, precision = "float64", params = None, algorithms = ("rf",),
+        report = "algorithms_report.csv") -> dict:
+    #Whole pipeline: load, preprocess, train and evaluate, save. Returns the stage timings.
+    #params apply to the random forest; with more than one algorithm the comparison is written in report.
+    timings = {}
+    with stage("load", timings):
+        data = get_snapshot(csv)
+    with stage("preprocess", timings):
+        # prepare data
+        df, label_encoders = preproc(data)
+    with stage("save_encoders", timings):
+        save_outputs({ENCODERS_FILE: lambda target: save_encoders(label_encoders, target)}, out_dir, overwrite)
+
+    rows = []
+    for algorithm in algorithms:
+        with stage(f"train_{algorithm}", timings):
+            #train model and get metrics
+            model, model_metrics = train_and_metric(df, evaluation, n_jobs, params if algorithm == "rf" else None,
+                algorithm, list(label_encoders))
+            model_metrics['country_names'] = label_encoders['country']
+
+        with stage(f"save_{algorithm}", timings):
+            files = ALGORITHMS[algorithm]
+            outputs = {
+                files["model"]: lambda target: joblib.dump(model, target),
+                files["metrics"]: lambda target: joblib.dump(model_metrics, target),
+            }
+            if algorithm == "rf":
+                # node arrays of the forest, loaded with memory mapping by the app and the service
+                outputs[FOREST_DIR] = lambda target: FlatForest.from_model(model).save(target, compress, precision)
+            save_outputs(outputs, out_dir, overwrite)
+        rows.append({"algorithm": algorithm, "fit_seconds": model_metrics["fit_seconds"],
+            "train_seconds": timings[f"train_{algorithm}"],
+            **speed_and_size(model, to_matrix(df.drop("is_canceled")), algorithm),
+            "auc": model_metrics["auc_score"]})
+        # only one model in memory at a time
+        del model
+
+    if len(rows) > 1:
+        comparison = pl.DataFrame(rows)
+        # a relative report goes to out_dir with the models
+        comparison.write_csv(os.path.join(out_dir, report))
+        with pl.Config(tbl_cols=-1):
+            print(comparison)
+    timings["total"] = sum(timings.values())
+    print(f"total: {timings['total']:.2f}s")
+    return timings
+
 def main():
-    # prepare data
-    df, label_encoders = preproc()
-    #train model and get metrics
-    model, model_metrics = train_and_metric(df)
-
-    # Check if the model already exists
-    if not exist("random_forest_model_0.pkl"):
-        # Save the model
-        joblib.dump(model, "random_forest_model_0.pkl")
-    if not exist("model_RF0_metrics.pkl"):
-        #save the model metrics
-        joblib.dump(model_metrics, "model_RF0_metrics.pkl")
-    if not exist("label_encoders_RF0.pkl"):
-        # save the label encoders
-        joblib.dump(label_encoders, "label_encoders_RF0.pkl")
+    parser = argparse.ArgumentParser(description="Train the cancellation model without running the Streamlit app")
+    parser.add_argument("--csv", default="hotel_bookings.csv")
+    parser.add_argument("--out-dir", default=".", help="directory of the model, metrics and encoders files")
+    parser.add_argument("--overwrite", action="store_true", help="replace the files already saved")
+    parser.add_argument("--evaluation", choices=["oof", "holdout"], default="oof",
+        help="oof: parallel cross-validation with out-of-fold metrics, holdout: 80/20 split plus cross_validate")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="processes used for the folds")
+    parser.add_argument("--compress", action="store_true", help="compressed forest artifact (not memory mapped)")
+    parser.add_argument("--precision", choices=["float64", "float32", "float16"], default="float64",
+        help="precision of the leaf probabilities in the forest artifact")
+    parser.add_argument("--params", help="json file of forest hyperparameters (e.g. best_params.json of tune.py)")
+    parser.add_argument("--algorithm", nargs="+", choices=list(ALGORITHMS), default=["rf"],
+        help="rf: random forest, hgb: histogram gradient boosting with native categorical splits")
+    parser.add_argument("--report", default="algorithms_report.csv", help="comparison of the algorithms trained together (relative to --out-dir)")
+    args = parser.parse_args()
+    params = None
+    if args.params:
+        with open(args.params) as f:
+            params = json.load(f)
+    run(args.csv, args.out_dir, args.overwrite, args.evaluation, args.n_jobs, args.compress, args.precision, params,
+        args.algorithm, args.report)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,136 @@
+import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import math
+import os
+import time
+
+import numpy as np
+import polars as pl
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import train_test_split
+
+import trainmodel
+from encoders import to_matrix
+from forest import FlatForest
+from preprocess import CACHE_DIR, get_snapshot, remove_stale, snapshot_key
+
+# Hyperparameter search for the forest of trainmodel.py with successive halving:
+# every configuration starts with few trees, at each round only the best 1/eta survive
+# and grow eta times more trees. The forests grow with warm_start (only the new trees
+# are fitted) on one cached encoded matrix, and every fit uses all the cores.
+# The leaderboard reports AUC (validation split), training time, latency and size.
+#
+# usage: uv run python tune.py --min-trees 20 --eta 3
+
+SEARCH_SPACE = {
+    "max_depth": [None, 24, 14],
+    "min_samples_leaf": [1, 4, 16],
+    "max_features": ["sqrt", 0.5],
+}
+
+
+def feature_matrix(path = "hotel_bookings.csv", cache_dir = CACHE_DIR):
+    #Encoded matrix and target of trainmodel.preproc, saved in .cache/ as .npy and memory mapped.
+    #The key covers the dataset and the code of preproc, so a change of either rebuilds it.
+    h = hashlib.sha256(snapshot_key(path).encode())
+    h.update(inspect.getsource(trainmodel.preproc).encode())
+    h.update(repr(trainmodel.num_c).encode())
+    key = h.hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    X_path = os.path.join(cache_dir, f"{stem}_features_{key}.npy")
+    y_path = os.path.join(cache_dir, f"{stem}_target_{key}.npy")
+    if not (os.path.exists(X_path) and os.path.exists(y_path)):
+        df, _ = trainmodel.preproc(get_snapshot(path, cache_dir))
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(y_path, df["is_canceled"].to_numpy())
+        np.save(X_path, to_matrix(df.drop("is_canceled")))
+        keep = [os.path.basename(X_path), os.path.basename(y_path)]
+        remove_stale(cache_dir, f"{stem}_features_*.npy", keep)
+        remove_stale(cache_dir, f"{stem}_target_*.npy", keep)
+    return np.load(X_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")
+
+def candidates(space = SEARCH_SPACE) -> list:
+    return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+
+def latency_and_size(model, X, repeat = 20):
+    #Median time (ms) of a single booking prediction with the flat engine (the one of the Modello page)
+    #and size (MB) of its arrays.
+    flat = FlatForest.from_model(model)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        flat.predict_proba(X[i:i + 1])
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000, flat.nbytes() / 2**20
+
+def successive_halving(X_train, y_train, X_valid, y_valid, configs, min_trees = 20, eta = 3, max_trees = 400):
+    #Rows of the leaderboard, one per configuration and round.
+    models = {i: trainmodel.new_model(params={**params, "n_estimators": 0}).set_params(warm_start=True)
+        for i, params in enumerate(configs)}
+    fit_seconds = dict.fromkeys(models, 0.0)
+    rows = []
+    trees, round_ = min_trees, 0
+    while True:
+        scores = {}
+        for i in list(models):
+            model = models[i]
+            start = time.perf_counter()
+            # warm start: only the trees added in this round are fitted
+            model.set_params(n_estimators=trees).fit(X_train, y_train)
+            fit_seconds[i] += time.perf_counter() - start
+            scores[i] = roc_auc_score(y_valid, model.predict_proba(X_valid)[:, 1])
+            print(f"round {round_} config {i} trees {trees}: auc {scores[i]:.4f} ({fit_seconds[i]:.1f}s)", flush=True)
+        keep = max(1, math.floor(len(models) / eta))
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        final = len(models) == 1 or trees * eta > max_trees
+        for rank, i in enumerate(ranked):
+            latency, size = latency_and_size(models[i], X_valid)
+            rows.append({"round": round_, "config": i, **{k: str(v) for k, v in configs[i].items()},
+                "n_estimators": trees, "auc": scores[i], "fit_seconds": fit_seconds[i],
+                "latency_ms": latency, "size_mb": size, "survived": not final and rank < keep})
+        if final:
+            return rows
+        # the forests of the discarded configurations are released at once
+        models = {i: models[i] for i in ranked[:keep]}
+        trees *= eta
+        round_ += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Successive halving search of the forest hyperparameters")
+    parser.add_argument("--csv", default="hotel_bookings.csv")
+    parser.add_argument("--min-trees", type=int, default=20, help="trees of every configuration in the first round")
+    parser.add_argument("--max-trees", type=int, default=400)
+    parser.add_argument("--eta", type=int, default=3, help="1/eta of the configurations survive each round")
+    parser.add_argument("--sample", type=float, default=1.0, help="fraction of the bookings used, for quick searches")
+    parser.add_argument("--leaderboard", default="tuning_leaderboard.csv")
+    parser.add_argument("--best", default="best_params.json", help="parameters of the winner, for trainmodel.py --params")
+    args = parser.parse_args()
+
+    X, y = feature_matrix(args.csv)
+    if args.sample < 1:
+        rows = np.random.default_rng(trainmodel.seed).random(len(y)) < args.sample
+        X, y = X[rows], y[rows]
+    X_train, X_valid, y_train, y_valid = train_test_split(np.asarray(X), np.asarray(y),
+        test_size=trainmodel.test_size, random_state=trainmodel.seed, stratify=y)
+    configs = candidates()
+    start = time.perf_counter()
+    rows = successive_halving(X_train, y_train, X_valid, y_valid, configs, args.min_trees, args.eta, args.max_trees)
+    print(f"search: {time.perf_counter() - start:.1f}s")
+
+    leaderboard = pl.DataFrame(rows).sort("round", "auc", descending=[True, True])
+    leaderboard.write_csv(args.leaderboard)
+    with pl.Config(tbl_rows=20, tbl_cols=-1):
+        print(leaderboard.head(20))
+    best = leaderboard.row(0, named=True)
+    params = {**configs[best["config"]], "n_estimators": best["n_estimators"]}
+    with open(args.best, "w") as f:
+        json.dump(params, f, indent=2)
+    print(f"best: {params} -> {args.best}")
+
+
+if __name__ == "__main__":
+    main()